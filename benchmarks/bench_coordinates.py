@@ -0,0 +1,65 @@
+# benchmarks/bench_coordinates.py
+"""
+Per-row cost of turning a location's coordinates into the GeoJSON dict that
+/locations/ returns: the old json.loads(ST_AsGeoJSON(...)) path against
+decoding ST_AsBinary(...) WKB locally.
+
+    python benchmarks/bench_coordinates.py --rows 10000
+"""
+import argparse
+import json
+import os
+import random
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from wkb import point_to_geojson  # noqa: E402
+
+
+def make_rows(count: int, seed: int = 0):
+    rng = random.Random(seed)
+    rows = []
+    for _ in range(count):
+        lon, lat = 80.04 + rng.uniform(0, 0.01), 12.82 + rng.uniform(0, 0.01)
+        # What MySQL hands back for ST_AsGeoJSON and ST_AsBinary respectively
+        geojson = json.dumps({"type": "Point", "coordinates": [lon, lat]})
+        wkb = struct.pack("<BIdd", 1, 1, lon, lat)
+        rows.append((geojson, wkb))
+    return rows
+
+
+def best_of(repeats, fn, rows):
+    timings = []
+    for _ in range(repeats):
+        started = time.perf_counter()
+        fn(rows)
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def decode_geojson(rows):
+    return [json.loads(geojson) for geojson, _ in rows]
+
+
+def decode_wkb(rows):
+    return [point_to_geojson(wkb) for _, wkb in rows]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    rows = make_rows(args.rows)
+    assert decode_geojson(rows[:100]) == decode_wkb(rows[:100])
+
+    before = best_of(args.repeats, decode_geojson, rows)
+    after = best_of(args.repeats, decode_wkb, rows)
+    print(f"{args.rows} rows")
+    print(f"json.loads(ST_AsGeoJSON): {before * 1000:8.2f} ms total, {before / args.rows * 1e6:6.2f} us/row")
+    print(f"WKB decode (ST_AsBinary): {after * 1000:8.2f} ms total, {after / args.rows * 1e6:6.2f} us/row")
+    print(f"speedup: {before / after:.1f}x")
@@ -0,0 +1,101 @@
+# benchmarks/bench_routing.py
+"""
+Compares the routing algorithms in graph.CampusGraph on synthetic campus-like
+grid graphs. "dijkstra" is the unidirectional search calculate_path used before.
+--ch also builds a contraction hierarchy (see ch.py) per size, reports how long
+that took, and times its queries on the same pairs.
+
+    python benchmarks/bench_routing.py --sizes 1000 10000 100000 --queries 50
+    python benchmarks/bench_routing.py --sizes 2500 10000 --ch
+"""
+import argparse
+import math
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from graph import CampusGraph, haversine, ALGORITHMS  # noqa: E402
+
+# Roughly 10 m between neighbouring grid nodes
+STEP_DEGREES = 0.0001
+
+
+def build_grid_graph(size: int, seed: int = 0) -> CampusGraph:
+    """
+    Builds a jittered grid of about `size` nodes with 4-neighbour symmetric
+    edges weighted by their great-circle length in meters.
+    """
+    rng = random.Random(seed)
+    width = max(2, int(math.sqrt(size)))
+    coordinates = []
+    edges = []
+    for index in range(width * width):
+        x, y = index % width, index // width
+        lon = 80.0 + (x + rng.uniform(-0.3, 0.3)) * STEP_DEGREES
+        lat = 12.8 + (y + rng.uniform(-0.3, 0.3)) * STEP_DEGREES
+        coordinates.append((lon, lat))
+        for neighbor in (index - 1 if x > 0 else None, index - width if y > 0 else None):
+            if neighbor is not None:
+                # Some corridors are longer than the straight line between their ends
+                distance = haversine(lon, lat, *coordinates[neighbor]) * rng.uniform(1.0, 1.5)
+                edges.append((index, neighbor, distance))
+                edges.append((neighbor, index, distance))
+    return CampusGraph.from_rows(
+        ((index, f"Location {index}", lon_lat) for index, lon_lat in enumerate(coordinates)), edges
+    )
+
+
+def _time_queries(search, pairs):
+    timings = []
+    for start_id, end_id in pairs:
+        started = time.perf_counter()
+        search(start_id, end_id)
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    mean = sum(timings) / len(timings)
+    p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+    return mean, p95
+
+
+def run(sizes, queries, seed, with_ch=False):
+    print(f"{'nodes':>8} {'algorithm':>20} {'mean ms':>10} {'p95 ms':>10} {'speedup':>8}")
+    for size in sizes:
+        graph = build_grid_graph(size, seed)
+        edge_count = len(graph.csr.targets)
+        print(f"{len(graph.nodes):>8} nodes, {edge_count} edges: "
+              f"{graph.memory_bytes() / 2 ** 20:.1f} MiB of graph arrays")
+        rng = random.Random(seed)
+        node_ids = list(graph.nodes)
+        pairs = [(rng.choice(node_ids), rng.choice(node_ids)) for _ in range(queries)]
+
+        baseline = None
+        for algorithm in ALGORITHMS:
+            mean, p95 = _time_queries(
+                lambda start_id, end_id: graph.shortest_path(start_id, end_id, algorithm=algorithm), pairs
+            )
+            if baseline is None:
+                baseline = mean
+            print(f"{len(node_ids):>8} {algorithm:>20} {mean:>10.3f} {p95:>10.3f} {baseline / mean:>7.1f}x")
+
+        if with_ch:
+            from ch import ContractionHierarchy
+
+            started = time.perf_counter()
+            hierarchy = ContractionHierarchy.build(graph.csr.compacted(), bytearray([1]) * len(graph.names))
+            print(f"{len(node_ids):>8} nodes: contraction hierarchy built in {time.perf_counter() - started:.1f}s, "
+                  f"{hierarchy.shortcut_count} shortcuts, {hierarchy.memory_bytes() / 2 ** 20:.1f} MiB")
+            mean, p95 = _time_queries(hierarchy.shortest_path, pairs)
+            print(f"{len(node_ids):>8} {'ch':>20} {mean:>10.3f} {p95:>10.3f} {baseline / mean:>7.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--queries", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--ch", action="store_true", help="also build and query a contraction hierarchy")
+    args = parser.parse_args()
+    run(args.sizes, args.queries, args.seed, with_ch=args.ch)
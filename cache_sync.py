@@ -0,0 +1,135 @@
+# cache_sync.py
+import os
+import threading
+import time
+from collections import defaultdict
+from typing import Dict, Optional
+
+from sqlalchemy import event, select
+from sqlalchemy.dialects.mysql import insert
+from sqlalchemy.orm import Session
+
+import models
+
+# Seconds between polls of cache_versions, so at most this stale across workers
+CACHE_SYNC_INTERVAL = float(os.getenv("CACHE_SYNC_INTERVAL", "1.0"))
+
+# Names in use
+LOCATIONS = "locations"
+POI = "poi"
+OCCUPANCY = "occupancy"
+EMERGENCY = "emergency"
+
+
+class CacheVersions:
+    """
+    Keeps the in-process caches of several worker processes in step.
+
+    graph_cache and the indexes keyed on its version, the search index,
+    response_cache, routing costs and nearest services all live in one
+    process and are patched by that process's own writes. Writes therefore
+    also bump a counter row in cache_versions inside their transaction, and
+    every process polls the table on a background thread. A version that
+    moved without this process having made the write calls the listeners
+    registered for that name, which drop what the other worker may have
+    changed.
+    """
+
+    def __init__(self, session_factory=None, interval: float = CACHE_SYNC_INTERVAL):
+        self._session_factory = session_factory
+        self.interval = interval
+        self._lock = threading.Lock()
+        # name -> last version this process accounted for; empty until the first poll
+        self._seen: Dict[str, int] = {}
+        self._polled = False
+        self._listeners = defaultdict(list)
+        self._thread: Optional[threading.Thread] = None
+
+    def add_listener(self, name: str, listener):
+        # Called as listener(db) when another process changed name
+        self._listeners[name].append(listener)
+
+    def bump(self, db, *names: str):
+        """
+        Increments the versions of names in db's current transaction. Once
+        it commits, this process counts them as seen, so its own writes do
+        not come back to it as foreign changes.
+        """
+        table = models.cache_versions
+        names = sorted(set(names))
+        # Sorted, so concurrent bumps of several rows lock them in the same order
+        statement = insert(table).values([{"name": name, "version": 1} for name in names])
+        db.execute(statement.on_duplicate_key_update(version=table.c.version + 1))
+        versions = db.execute(select(table.c.name, table.c.version).where(table.c.name.in_(names))).all()
+        db.info.setdefault("cache_versions", {}).update(versions)
+
+    def _acknowledge(self, versions: Dict[str, int]):
+        with self._lock:
+            for name, version in versions.items():
+                # Only if nobody else got in between; otherwise the poll
+                # still has to report the other write
+                if self._polled and self._seen.get(name, 0) == version - 1:
+                    self._seen[name] = version
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name="cache-sync", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.poll()
+            except Exception as e:
+                print(f"Error polling cache versions: {str(e)}")
+            time.sleep(self.interval)
+
+    def poll(self):
+        """
+        Reads cache_versions and calls the listeners of every name another
+        process bumped since the last poll
+        """
+        db = self._session()
+        try:
+            rows = db.execute(select(models.cache_versions.c.name, models.cache_versions.c.version)).all()
+            changed = []
+            with self._lock:
+                for name, version in rows:
+                    if self._polled and self._seen.get(name, 0) != version:
+                        changed.append(name)
+                    self._seen[name] = version
+                self._polled = True
+            # The listeners read from the database; start from a fresh transaction
+            db.rollback()
+            for name in changed:
+                for listener in self._listeners[name]:
+                    try:
+                        listener(db)
+                    except Exception as e:
+                        print(f"Error in cache version listener for {name}: {str(e)}")
+        finally:
+            db.close()
+
+    def _session(self):
+        if self._session_factory is None:
+            from database import SessionLocal
+            self._session_factory = SessionLocal
+        return self._session_factory()
+
+
+cache_versions = CacheVersions()
+
+
+@event.listens_for(Session, "after_commit")
+def _committed(session):
+    versions = session.info.pop("cache_versions", None)
+    if versions:
+        cache_versions._acknowledge(versions)
+
+
+@event.listens_for(Session, "after_rollback")
+def _rolled_back(session):
+    # The bumps were rolled back with everything else
+    session.info.pop("cache_versions", None)
@@ -0,0 +1,551 @@
+# ch.py
+"""
+Contraction hierarchy over the campus walking graph.
+
+Preprocessing contracts nodes one at a time in order of importance and adds a
+shortcut edge wherever removing a node would lengthen a shortest path. Queries
+then run a bidirectional Dijkstra that only ever moves "upward" in that order,
+which settles a tiny fraction of the graph.
+
+Run ``python ch.py`` to build the hierarchy for the configured database and
+save it to CH_HIERARCHY_PATH; the server loads that file at startup as long as
+the graph has not changed since, and rebuilds in the background otherwise.
+"""
+import heapq
+import json
+import os
+import pickle
+import subprocess
+import sys
+import threading
+import time
+from array import array
+from typing import Dict, List, Optional, Tuple
+
+from graph import graph_cache
+
+# Where the offline build is saved and the server looks for it
+CH_HIERARCHY_PATH = os.getenv("CH_HIERARCHY_PATH", "campus_hierarchy.ch")
+# Witness searches give up after settling this many nodes; a missed witness only
+# costs a redundant shortcut, never a wrong answer
+WITNESS_SETTLE_LIMIT = 80
+# The simulations that rank nodes run far more often than contractions, so
+# they search less and only estimate the shortcut count
+SIMULATION_SETTLE_LIMIT = 40
+# Seconds to wait after a graph change before rebuilding, so a burst of
+# location writes costs one rebuild
+REBUILD_DELAY = float(os.getenv("CH_REBUILD_DELAY", "5.0"))
+
+# Script the background rebuilds run in
+CH_WORKER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ch_worker.py")
+
+FILE_FORMAT = 1
+_FINGERPRINT_MASK = (1 << 64) - 1
+
+
+def graph_fingerprint(csr, alive) -> int:
+    """
+    Order-independent hash of the locations and edges of a compacted
+    CSRGraph, used to tell whether a saved hierarchy still matches it
+    """
+    ids, offsets, targets, weights = csr.ids, csr.offsets, csr.targets, csr.weights
+    total = 0
+    for position in range(csr.base_size):
+        if not alive[position]:
+            continue
+        from_id = ids[position]
+        total = (total + hash((from_id,))) & _FINGERPRINT_MASK
+        for slot in range(offsets[position], offsets[position + 1]):
+            total = (total + hash((from_id, ids[targets[slot]], weights[slot]))) & _FINGERPRINT_MASK
+    return total
+
+
+class ContractionHierarchy:
+    """
+    Nodes are numbered by contraction rank. The upward edges of rank r are
+    targets[offsets[r]:offsets[r + 1]], all of higher rank, with the same
+    slice of weights; middle holds the rank of the node a shortcut bypasses,
+    or -1 for an original edge.
+    """
+
+    def __init__(self, version: int = 0):
+        self.version = version
+        self.fingerprint = 0
+        # rank -> location id
+        self.ids = array('q')
+        # location id -> rank, -1 where there is none
+        self.rank = array('i')
+        self.offsets = array('q', [0])
+        self.targets = array('i')
+        self.weights = array('d')
+        self.middle = array('i')
+        self.shortcut_count = 0
+
+    @classmethod
+    def build(cls, csr, alive, version: int = 0):
+        """
+        Builds the hierarchy from a compacted CSRGraph, skipping indices
+        whose alive flag is 0. Edges are treated as undirected, matching the
+        symmetric rows create_location writes.
+
+        Node priorities are the edge difference of a simulated contraction,
+        plus the number of already contracted neighbours and the node's
+        depth in the hierarchy. They are kept between steps and only the
+        neighbours of a contracted node are simulated again, since no other
+        node's neighbourhood changed.
+        """
+        hierarchy = cls(version)
+        ids, offsets, targets, weights = csr.ids, csr.offsets, csr.targets, csr.weights
+        size = csr.base_size
+        infinity = float('infinity')
+
+        # position -> {neighbour position: distance} over uncontracted nodes
+        remaining: List[Optional[Dict[int, float]]] = [
+            {} if alive[position] else None for position in range(size)
+        ]
+        for position in range(size):
+            own = remaining[position]
+            if own is None:
+                continue
+            for slot in range(offsets[position], offsets[position + 1]):
+                target, distance = targets[slot], weights[slot]
+                if target == position or remaining[target] is None:
+                    continue
+                if distance < own.get(target, infinity):
+                    own[target] = distance
+                    remaining[target][position] = distance
+
+        # (lower position, higher position) -> position a shortcut bypasses
+        middle: Dict[Tuple[int, int], int] = {}
+        contracted_neighbors = array('i', [0]) * size
+        depth = array('i', [0]) * size
+        # Latest priority of each node, so stale queue entries can be told apart
+        priorities = array('q', [0]) * size
+        pq = []
+        for position in range(size):
+            if remaining[position] is not None:
+                priorities[position] = _priority(remaining, contracted_neighbors, depth, position)
+                pq.append((priorities[position], position))
+        heapq.heapify(pq)
+
+        order: List[int] = []
+        upward: List[List[Tuple[int, float]]] = []
+        while pq:
+            priority, position = heapq.heappop(pq)
+            if remaining[position] is None or priorities[position] != priority:
+                # Superseded by a later push for the same node
+                continue
+
+            neighbors = remaining[position]
+            shortcuts = _shortcuts(remaining, position, neighbors)
+            remaining[position] = None
+            for from_pos, to_pos, distance in shortcuts:
+                if distance < remaining[from_pos].get(to_pos, infinity):
+                    remaining[from_pos][to_pos] = distance
+                    remaining[to_pos][from_pos] = distance
+                    middle[(min(from_pos, to_pos), max(from_pos, to_pos))] = position
+                    hierarchy.shortcut_count += 1
+
+            order.append(position)
+            upward.append(list(neighbors.items()))
+            for neighbor in neighbors:
+                del remaining[neighbor][position]
+                contracted_neighbors[neighbor] += 1
+                depth[neighbor] = max(depth[neighbor], depth[position] + 1)
+            for neighbor in neighbors:
+                priorities[neighbor] = _priority(remaining, contracted_neighbors, depth, neighbor)
+                heapq.heappush(pq, (priorities[neighbor], neighbor))
+
+        rank_of = array('i', [-1]) * size
+        for rank, position in enumerate(order):
+            rank_of[position] = rank
+        for rank, position in enumerate(order):
+            for neighbor, distance in upward[rank]:
+                hierarchy.targets.append(rank_of[neighbor])
+                hierarchy.weights.append(distance)
+                via = middle.get((min(position, neighbor), max(position, neighbor)))
+                hierarchy.middle.append(-1 if via is None else rank_of[via])
+            hierarchy.offsets.append(len(hierarchy.targets))
+        hierarchy.ids = array('q', (ids[position] for position in order))
+        hierarchy._index_ids()
+        return hierarchy
+
+    def _index_ids(self):
+        ids = self.ids
+        self.rank = array('i', [-1]) * ((max(ids) + 1) if ids else 0)
+        for rank, location_id in enumerate(ids):
+            self.rank[location_id] = rank
+
+    def _rank_of(self, location_id: int) -> int:
+        if 0 <= location_id < len(self.rank):
+            return self.rank[location_id]
+        return -1
+
+    def shortest_path(self, start_id: int, end_id: int) -> Optional[Tuple[float, List[int]]]:
+        """
+        Returns (total_distance, [location_id, ...]) or None if unreachable.
+
+        The two upward searches take turns by smallest key, each stopping
+        once it cannot beat the best meeting point, and stall on demand: a
+        node that a higher-ranked node already reaches more cheaply cannot be
+        on the shortest up-down path, so its edges are not relaxed.
+        """
+        start = self._rank_of(start_id)
+        end = self._rank_of(end_id)
+        if start < 0 or end < 0:
+            return None
+        if start == end:
+            return 0.0, [start_id]
+
+        offsets, targets, weights = self.offsets, self.targets, self.weights
+        infinity = float('infinity')
+        distances = ({start: 0.0}, {end: 0.0})
+        previous = ({start: -1}, {end: -1})
+        queues = ([(0.0, start)], [(0.0, end)])
+        best = infinity
+        meeting = -1
+
+        while True:
+            forward = queues[0][0][0] if queues[0] else infinity
+            backward = queues[1][0][0] if queues[1] else infinity
+            if min(forward, backward) >= best:
+                break
+            side = 0 if forward <= backward else 1
+            current_distance, current = heapq.heappop(queues[side])
+            own_distances = distances[side]
+            if current_distance > own_distances[current]:
+                continue
+            other_distance = distances[1 - side].get(current)
+            if other_distance is not None and current_distance + other_distance < best:
+                best = current_distance + other_distance
+                meeting = current
+
+            first, last = offsets[current], offsets[current + 1]
+            stalled = False
+            for slot in range(first, last):
+                higher = own_distances.get(targets[slot])
+                if higher is not None and higher + weights[slot] < current_distance:
+                    stalled = True
+                    break
+            if stalled:
+                continue
+
+            own_previous = previous[side]
+            for slot in range(first, last):
+                neighbor = targets[slot]
+                distance = current_distance + weights[slot]
+                if distance < own_distances.get(neighbor, infinity):
+                    own_distances[neighbor] = distance
+                    own_previous[neighbor] = current
+                    heapq.heappush(queues[side], (distance, neighbor))
+
+        if meeting < 0:
+            return None
+
+        up_path = []
+        current = meeting
+        while current >= 0:
+            up_path.append(current)
+            current = previous[0][current]
+        up_path.reverse()
+        current = previous[1][meeting]
+        while current >= 0:
+            up_path.append(current)
+            current = previous[1][current]
+
+        ids = self.ids
+        path = [ids[up_path[0]]]
+        for from_rank, to_rank in zip(up_path, up_path[1:]):
+            path.extend(ids[rank] for rank in self._unpack(from_rank, to_rank))
+        return best, path
+
+    def _middle(self, a: int, b: int) -> int:
+        low, high = (a, b) if a < b else (b, a)
+        targets = self.targets
+        for slot in range(self.offsets[low], self.offsets[low + 1]):
+            if targets[slot] == high:
+                return self.middle[slot]
+        return -1
+
+    def _unpack(self, from_rank: int, to_rank: int) -> List[int]:
+        """
+        Expands a (possibly shortcut) edge into the original nodes after from_rank
+        """
+        result = []
+        stack = [(from_rank, to_rank)]
+        while stack:
+            a, b = stack.pop()
+            via = self._middle(a, b)
+            if via < 0:
+                result.append(b)
+            else:
+                stack.append((via, b))
+                stack.append((a, via))
+        return result
+
+    def memory_bytes(self) -> int:
+        arrays = (self.ids, self.rank, self.offsets, self.targets, self.weights, self.middle)
+        return sum(len(values) * values.itemsize for values in arrays)
+
+    def save(self, path: str):
+        """
+        Writes the hierarchy next to path and moves it into place, so
+        readers never see a partial file
+        """
+        arrays = (self.ids, self.offsets, self.targets, self.weights, self.middle)
+        header = {
+            "format": FILE_FORMAT,
+            "byteorder": sys.byteorder,
+            "fingerprint": self.fingerprint,
+            "shortcuts": self.shortcut_count,
+            "lengths": [len(values) for values in arrays],
+        }
+        temporary = f"{path}.{os.getpid()}.tmp"
+        with open(temporary, "wb") as fp:
+            fp.write(json.dumps(header).encode() + b"\n")
+            for values in arrays:
+                values.tofile(fp)
+        os.replace(temporary, path)
+
+    @classmethod
+    def load(cls, path: str, version: int = 0) -> Optional["ContractionHierarchy"]:
+        """
+        Reads a hierarchy written by save(), or None if path does not hold one
+        """
+        try:
+            with open(path, "rb") as fp:
+                header = json.loads(fp.readline())
+                if header.get("format") != FILE_FORMAT or header.get("byteorder") != sys.byteorder:
+                    return None
+                hierarchy = cls(version)
+                hierarchy.fingerprint = header["fingerprint"]
+                hierarchy.shortcut_count = header["shortcuts"]
+                arrays = (array('q'), array('q'), array('i'), array('d'), array('i'))
+                for values, length in zip(arrays, header["lengths"]):
+                    values.fromfile(fp, length)
+        except (OSError, ValueError, KeyError, EOFError):
+            return None
+        hierarchy.ids, hierarchy.offsets, hierarchy.targets, hierarchy.weights, hierarchy.middle = arrays
+        hierarchy._index_ids()
+        return hierarchy
+
+
+def _priority(remaining, contracted_neighbors, depth, position) -> int:
+    """
+    Edge difference of a simulated contraction of position, plus terms that
+    spread contraction evenly over the graph and keep the hierarchy shallow
+    """
+    neighbors = remaining[position]
+    shortcuts = _shortcuts(remaining, position, neighbors, SIMULATION_SETTLE_LIMIT)
+    return 2 * (len(shortcuts) - len(neighbors)) + contracted_neighbors[position] + depth[position]
+
+
+def _shortcuts(remaining, position, neighbors, settle_limit=WITNESS_SETTLE_LIMIT):
+    """
+    Shortcuts needed to contract position: one for every pair of neighbours
+    whose shortest connection runs through it
+    """
+    infinity = float('infinity')
+    shortcuts = []
+    neighbor_list = list(neighbors.items())
+    for i, (from_pos, from_distance) in enumerate(neighbor_list):
+        # A direct edge is the cheapest witness to check, so only pairs it
+        # does not cover need a search
+        own = remaining[from_pos]
+        targets = {}
+        for to_pos, to_distance in neighbor_list[i + 1:]:
+            via_distance = from_distance + to_distance
+            if own.get(to_pos, infinity) > via_distance:
+                targets[to_pos] = via_distance
+        if not targets:
+            continue
+        witness = _witness_search(remaining, from_pos, position, targets, max(targets.values()), settle_limit)
+        for to_pos, via_distance in targets.items():
+            if witness.get(to_pos, infinity) > via_distance:
+                shortcuts.append((from_pos, to_pos, via_distance))
+    return shortcuts
+
+
+def _witness_search(remaining, source, excluded, targets, max_distance, settle_limit):
+    """
+    Bounded Dijkstra from source over the uncontracted graph that avoids
+    excluded, stopping once every target is settled
+    """
+    distances = {source: 0.0}
+    pq = [(0.0, source)]
+    settled = 0
+    unsettled = len(targets)
+    heappop, heappush = heapq.heappop, heapq.heappush
+    while pq and settled < settle_limit:
+        current_distance, current = heappop(pq)
+        if current_distance > distances[current]:
+            continue
+        settled += 1
+        if current in targets:
+            unsettled -= 1
+            if not unsettled:
+                break
+        for neighbor, weight in remaining[current].items():
+            distance = current_distance + weight
+            if distance <= max_distance and neighbor != excluded:
+                known = distances.get(neighbor)
+                if known is None or distance < known:
+                    distances[neighbor] = distance
+                    heappush(pq, (distance, neighbor))
+    return distances
+
+
+class HierarchyCache:
+    """
+    Keeps a ContractionHierarchy in step with graph_cache.
+
+    The first hierarchy comes from the file ``python ch.py`` saved, if it
+    matches the loaded graph. A graph change only marks the hierarchy out of
+    date; the next get() schedules a rebuild, delayed by REBUILD_DELAY so a
+    burst of writes costs one build, which runs in a worker process so it
+    does not hold the GIL the request threads need. Each rebuild is saved
+    for the next start. Until a current hierarchy is ready, get() returns
+    None and callers fall back to searching the plain graph.
+    """
+
+    def __init__(self, graph_cache, path: Optional[str] = CH_HIERARCHY_PATH):
+        self._graph_cache = graph_cache
+        self._path = path
+        self._hierarchy: Optional[ContractionHierarchy] = None
+        self._lock = threading.Lock()
+        self._building = False
+        self._tried_saved = False
+        # Graph version whose build failed, so get() does not retry it per request
+        self._failed_version = None
+        # When the graph last changed, to hold rebuilds back until writes settle
+        self._changed_at = 0.0
+        graph_cache.add_listener(self._graph_changed)
+
+    def get(self, db) -> Optional[ContractionHierarchy]:
+        hierarchy = self._hierarchy
+        version = self._graph_cache.version
+        if hierarchy is not None and hierarchy.version == version:
+            return hierarchy
+        # Make sure the graph is loaded so the rebuild has something to read
+        self._graph_cache.get(db)
+        if self._failed_version != version:
+            self.schedule_rebuild()
+        return None
+
+    def warm(self, session_factory):
+        """
+        Loads the graph and the saved hierarchy in the background, so the
+        first queries after startup can use it. A missing or stale file is
+        left for get() to rebuild, so servers that never query the
+        hierarchy never build it.
+        """
+        def load():
+            db = session_factory()
+            try:
+                self._graph_cache.get(db)
+            finally:
+                db.close()
+            self._refresh(build=False)
+        threading.Thread(target=load, name="ch-warm", daemon=True).start()
+
+    def _graph_changed(self, change):
+        self._changed_at = time.monotonic()
+
+    def schedule_rebuild(self):
+        with self._lock:
+            if self._building:
+                return
+            self._building = True
+        threading.Thread(target=self._rebuild, name="ch-rebuild", daemon=True).start()
+
+    def _rebuild(self):
+        version = None
+        try:
+            while True:
+                wait = self._changed_at + REBUILD_DELAY - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+                    continue
+                version = self._graph_cache.version
+                built = self._refresh()
+                with self._lock:
+                    # Writes that land during a build leave it out of date;
+                    # go round again only if they have
+                    if built is None or built == self._graph_cache.version:
+                        self._building = False
+                        return
+        except Exception as e:
+            print(f"Error building contraction hierarchy: {str(e)}")
+            with self._lock:
+                self._failed_version = version
+                self._building = False
+
+    def _refresh(self, build: bool = True) -> Optional[int]:
+        """
+        Makes the hierarchy current, from the saved file or, if build is
+        set, by contracting the graph. Returns the graph version it now
+        matches, or None if the graph is not loaded or nothing matched.
+        """
+        snapshot = self._graph_cache.snapshot()
+        if snapshot is None:
+            return None
+        version, csr, alive = snapshot
+        current = self._hierarchy
+        if current is not None and current.version == version:
+            return version
+        fingerprint = graph_fingerprint(csr, alive)
+
+        if self._path and not self._tried_saved:
+            # Only the graph as first loaded can match the saved file
+            self._tried_saved = True
+            saved = ContractionHierarchy.load(self._path, version)
+            if saved is not None and saved.fingerprint == fingerprint:
+                self._hierarchy = saved
+                return version
+        if not build:
+            return None
+
+        # A fresh interpreter running ch_worker.py rather than a fork, so the
+        # worker inherits none of the server's threads or the locks they
+        # might hold, nor re-runs its main module
+        result = subprocess.run(
+            [sys.executable, CH_WORKER_PATH],
+            input=pickle.dumps((csr, alive, version), protocol=pickle.HIGHEST_PROTOCOL),
+            stdout=subprocess.PIPE,
+            check=True,
+        )
+        hierarchy = pickle.loads(result.stdout)
+        hierarchy.fingerprint = fingerprint
+        self._hierarchy = hierarchy
+        if self._path:
+            hierarchy.save(self._path)
+        return version
+
+
+hierarchy_cache = HierarchyCache(graph_cache)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from database import SessionLocal
+
+    parser = argparse.ArgumentParser(description="Build and save the contraction hierarchy")
+    parser.add_argument("--output", default=CH_HIERARCHY_PATH, help=f"default: {CH_HIERARCHY_PATH}")
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        graph_cache.get(db)
+    finally:
+        db.close()
+    _, csr, alive = graph_cache.snapshot()
+
+    started = time.perf_counter()
+    hierarchy = ContractionHierarchy.build(csr, alive)
+    elapsed = time.perf_counter() - started
+    hierarchy.fingerprint = graph_fingerprint(csr, alive)
+    hierarchy.save(args.output)
+    print(f"Contracted {sum(alive)} locations and {len(csr.targets)} edges "
+          f"in {elapsed:.2f}s, adding {hierarchy.shortcut_count} shortcuts; "
+          f"saved {hierarchy.memory_bytes() / 2 ** 20:.1f} MiB to {args.output}")
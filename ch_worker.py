@@ -0,0 +1,25 @@
+# ch_worker.py
+"""
+Child process for HierarchyCache rebuilds. Reads the pickled (csr, alive,
+version) snapshot from stdin, contracts it and writes the pickled
+ContractionHierarchy to stdout.
+
+It is its own script so the child imports ch and the graph modules only;
+a multiprocessing spawn worker would re-import the server's __main__, which
+under ``python main.py`` creates the tables, connects to the database and
+builds the app.
+"""
+import pickle
+import sys
+
+from ch import ContractionHierarchy
+
+
+def main():
+    csr, alive, version = pickle.load(sys.stdin.buffer)
+    hierarchy = ContractionHierarchy.build(csr, alive, version)
+    pickle.dump(hierarchy, sys.stdout.buffer, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+if __name__ == "__main__":
+    main()
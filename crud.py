@@ -1,17 +1,26 @@
 # crud.py
 from sqlalchemy.orm import Session, joinedload
-from sqlalchemy import func
+from sqlalchemy import and_, bindparam, func, or_, select
 from sqlalchemy.sql.expression import cast
-from geoalchemy2.functions import ST_AsGeoJSON
 from geoalchemy2.shape import to_shape
 from shapely.geometry import Point as ShapelyPoint
-import json
 import models, schemas
-import heapq
 from typing import List, Optional, Dict, Any, Tuple
-from sqlalchemy.orm import Session
-import models, schemas
 from security import pwd_context
+from graph import graph_cache, tree_cache
+from ch import hierarchy_cache
+from emergency import nearest_service_index
+from spatial import location_index
+from search import search_index
+from user_cache import user_cache
+from wkb import point_from_wkb, point_to_geojson
+from geo import haversine_distances
+from floors import climb_cost, edge_kind, layered_graph
+import numpy as np
+from response_cache import response_cache
+from poi_stream import poi_broadcaster
+from routing_costs import routing_costs
+from cache_sync import EMERGENCY, LOCATIONS, POI, cache_versions
 
 from passlib.context import CryptContext  # Import where used
 
@@ -41,6 +50,18 @@ def create_user(db: Session, user: schemas.UserCreate, hashed_password: str):
     db.commit()
     db.refresh(db_user)
     return db_user
+
+def update_user(db: Session, user_id: int, user: schemas.UserUpdate):
+    db_user = get_user(db, user_id)
+    for key, value in user.dict(exclude_unset=True).items():
+        if value is not None:
+            setattr(db_user, key, value)
+    db.commit()
+    db.refresh(db_user)
+    # Role and active flag are part of the cached principal
+    user_cache.invalidate(db_user.username)
+    return db_user
+
 # Option 2: Import pwd_context inside the function (if it's defined elsewhere)
 
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
@@ -59,13 +80,10 @@ def get_location(db: Session, location_id: int):
     location = db.query(models.Location).filter(models.Location.id == location_id).first()
     return location
 
-from sqlalchemy import func
-from geoalchemy2.functions import ST_AsGeoJSON
-import json
-
-def get_locations(db: Session, skip: int = 0, limit: int = 100):
-    # Query locations with coordinates converted to GeoJSON
-    locations = db.query(
+def _location_select(after_id: Optional[int] = None):
+    # Select locations with coordinates as raw WKB, in id order so after_id
+    # can be used as a keyset cursor. Shared with crud_async.
+    stmt = select(
         models.Location.id,
         models.Location.name,
         models.Location.description,
@@ -73,26 +91,163 @@ def get_locations(db: Session, skip: int = 0, limit: int = 100):
         models.Location.floor,
         models.Location.room_number,
         models.Location.category,
-        func.ST_AsGeoJSON(models.Location.coordinates).label('coordinates_geojson')
-    ).offset(skip).limit(limit).all()
-    
-    # Convert the result to a list of dictionaries with properly formatted coordinates
+        func.ST_AsBinary(models.Location.coordinates).label('coordinates_wkb')
+    )
+    if after_id is not None:
+        stmt = stmt.where(models.Location.id > after_id)
+    return stmt.order_by(models.Location.id)
+
+def _location_page_select(skip: int = 0, limit: int = 100, after_id: Optional[int] = None):
+    stmt = _location_select(after_id)
+    if after_id is None:
+        stmt = stmt.offset(skip)
+    return stmt.limit(limit)
+
+def _location_dict(loc):
+    return {
+        'id': loc.id,
+        'name': loc.name,
+        'description': loc.description,
+        'building': loc.building,
+        'floor': loc.floor,
+        'room_number': loc.room_number,
+        'category': loc.category,
+        'coordinates': point_to_geojson(loc.coordinates_wkb)  # Decode WKB locally, no JSON round trip
+    }
+
+def _location_document(db_location, point):
+    # Same shape as _location_dict, built from an ORM row and its decoded point
+    return {
+        'id': db_location.id,
+        'name': db_location.name,
+        'description': db_location.description,
+        'building': db_location.building,
+        'floor': db_location.floor,
+        'room_number': db_location.room_number,
+        'category': db_location.category,
+        'coordinates': {'type': 'Point', 'coordinates': [point.x, point.y]}
+    }
+
+def _load_search_documents(db: Session):
+    return (_location_dict(loc) for loc in db.execute(_location_select()))
+
+def search_locations(db: Session, q: str, limit: int = 10):
+    search_index.ensure_loaded(db, _load_search_documents)
+    return search_index.search(q, limit=limit)
+
+def get_locations(db: Session, skip: int = 0, limit: int = 100, after_id: Optional[int] = None):
+    """
+    One page of locations. With after_id the page starts right after that id
+    (keyset pagination) and skip is ignored.
+    """
+    rows = db.execute(_location_page_select(skip, limit, after_id))
+    return [_location_dict(loc) for loc in rows]
+
+def iter_locations(db: Session, after_id: Optional[int] = None, limit: Optional[int] = None, batch_size: int = 500):
+    """
+    Yields location dicts as rows arrive, fetching batch_size rows at a time
+    from a server-side cursor instead of materialising the whole table
+    """
+    stmt = _location_select(after_id).execution_options(stream_results=True)
+    if limit is not None:
+        stmt = stmt.limit(limit)
+    for partition in db.execute(stmt).partitions(batch_size):
+        for loc in partition:
+            yield _location_dict(loc)
+
+def get_nearest_locations(db: Session, lon: float, lat: float, k: int = 1):
+    """
+    The k locations closest to (lon, lat), nearest first, with their
+    great-circle distance in meters
+    """
+    graph = graph_cache.get(db)
     result = []
-    for loc in locations:
-        # Convert to dict
-        loc_dict = {
-            'id': loc.id,
-            'name': loc.name,
-            'description': loc.description,
-            'building': loc.building,
-            'floor': loc.floor,
-            'room_number': loc.room_number,
-            'category': loc.category,
-            'coordinates': json.loads(loc.coordinates_geojson)  # Parse GeoJSON string to dict
-        }
-        result.append(loc_dict)
-    
+    for location_id, distance in location_index.nearest(db, lon, lat, k):
+        loc_lon, loc_lat = graph.coordinates[location_id]
+        result.append(schemas.NearestLocation(
+            location_id=location_id,
+            name=graph.nodes[location_id],
+            coordinates=schemas.Point(type="Point", coordinates=[loc_lon, loc_lat]),
+            distance=distance
+        ))
     return result
+
+def snap_to_location(db: Session, lon: float, lat: float) -> Optional[int]:
+    """
+    Id of the graph node nearest to a raw coordinate, or None if there are no locations
+    """
+    nearest = location_index.nearest(db, lon, lat, 1)
+    return nearest[0][0] if nearest else None
+
+def _edge_distances(db: Session, location_id: int, lon: float, lat: float, floor: Optional[int], neighbor_ids,
+                    transitions: Optional[Dict[int, str]] = None) -> Tuple[Dict[int, float], Dict[int, str]]:
+    """
+    Distances in meters from (lon, lat) to the existing locations among
+    neighbor_ids, plus the edge kinds. Coordinates come from one IN query and
+    all lengths from one vectorized haversine pass; edges to another floor
+    add the climb for their kind.
+    """
+    neighbor_ids = [neighbor_id for neighbor_id in dict.fromkeys(neighbor_ids) if neighbor_id != location_id]
+    if not neighbor_ids:
+        return {}, {}
+    rows = db.execute(
+        select(models.Location.id, models.Location.floor, func.ST_AsBinary(models.Location.coordinates))
+        .where(models.Location.id.in_(neighbor_ids))
+    ).all()
+    if not rows:
+        return {}, {}
+
+    ends = np.array([point_from_wkb(wkb) for _, _, wkb in rows], dtype=float)
+    distances = haversine_distances(lon, lat, ends[:, 0], ends[:, 1]).tolist()
+    transitions = transitions or {}
+    neighbors, kinds = {}, {}
+    for (neighbor_id, neighbor_floor, _), distance in zip(rows, distances):
+        kind = edge_kind(floor, neighbor_floor, transitions.get(neighbor_id))
+        neighbors[neighbor_id] = distance + climb_cost(kind, floor, neighbor_floor)
+        kinds[neighbor_id] = kind
+    return neighbors, kinds
+
+def _insert_edges(db: Session, location_id: int, neighbors: Dict[int, float], kinds: Dict[int, str]):
+    # Both directions in one executemany
+    if not neighbors:
+        return
+    edge_rows = []
+    for neighbor_id, distance in neighbors.items():
+        kind = kinds[neighbor_id]
+        edge_rows.append({'from_id': location_id, 'to_id': neighbor_id, 'distance': distance, 'kind': kind})
+        edge_rows.append({'from_id': neighbor_id, 'to_id': location_id, 'distance': distance, 'kind': kind})
+    db.execute(models.path_edges.insert(), edge_rows)
+
+def _delete_edges(db: Session, location_id: int, neighbor_ids: List[int]):
+    # Both directions in one statement
+    if not neighbor_ids:
+        return
+    edges = models.path_edges.c
+    db.execute(models.path_edges.delete().where(or_(
+        and_(edges.from_id == location_id, edges.to_id.in_(neighbor_ids)),
+        and_(edges.to_id == location_id, edges.from_id.in_(neighbor_ids)),
+    )))
+
+def _update_edge_distances(db: Session, location_id: int, neighbors: Dict[int, float], kinds: Dict[int, str]):
+    # Both directions in one executemany
+    if not neighbors:
+        return
+    edges = models.path_edges.c
+    statement = models.path_edges.update().where(or_(
+        and_(edges.from_id == location_id, edges.to_id == bindparam('b_neighbor_id')),
+        and_(edges.to_id == location_id, edges.from_id == bindparam('b_neighbor_id')),
+    )).values(distance=bindparam('b_distance'), kind=bindparam('b_kind'))
+    db.execute(statement, [
+        {'b_neighbor_id': neighbor_id, 'b_distance': distance, 'b_kind': kinds[neighbor_id]}
+        for neighbor_id, distance in neighbors.items()
+    ])
+
+def _current_neighbors(db: Session, location_id: int) -> Dict[int, str]:
+    # neighbor_id -> edge kind
+    return dict(db.execute(
+        select(models.path_edges.c.to_id, models.path_edges.c.kind).where(models.path_edges.c.from_id == location_id)
+    ).all())
+
 def create_location(db: Session, location: schemas.LocationCreate):
     point = ShapelyPoint(location.coordinates.coordinates[0], location.coordinates.coordinates[1])
     db_location = models.Location(
@@ -109,111 +264,105 @@ def create_location(db: Session, location: schemas.LocationCreate):
     db.refresh(db_location)
     
     # Add connections if any
+    neighbors = {}
     if location.connected_to:
-        for connected_id in location.connected_to:
-            connected_location = get_location(db, connected_id)
-            if connected_location:
-                # Calculate Euclidean distance between points
-                loc1_point = to_shape(db_location.coordinates)
-                loc2_point = to_shape(connected_location.coordinates)
-                distance = loc1_point.distance(loc2_point)
-                
-                # Add edge in both directions
-                stmt = models.path_edges.insert().values(
-                    from_id=db_location.id,
-                    to_id=connected_id,
-                    distance=distance
-                )
-                db.execute(stmt)
-                
-                stmt = models.path_edges.insert().values(
-                    from_id=connected_id,
-                    to_id=db_location.id,
-                    distance=distance
-                )
-                db.execute(stmt)
-                
-        db.commit()
+        neighbors, kinds = _edge_distances(db, db_location.id, point.x, point.y, location.floor,
+                                           location.connected_to, location.transitions)
+        _insert_edges(db, db_location.id, neighbors, kinds)
+    cache_versions.bump(db, LOCATIONS)
+    db.commit()
     
+    graph_cache.add_location(db_location.id, db_location.name, (point.x, point.y), neighbors)
+    search_index.upsert(_location_document(db_location, point))
+    response_cache.invalidate("locations")
     return db_location
 
 def update_location(db: Session, location_id: int, location: schemas.LocationUpdate):
     db_location = get_location(db, location_id)
+    floor = db_location.floor
     
     # Update basic fields
     update_data = location.dict(exclude_unset=True)
     for key, value in update_data.items():
-        if key != "coordinates" and key != "connected_to" and value is not None:
+        if key not in ("coordinates", "connected_to", "transitions") and value is not None:
             setattr(db_location, key, value)
+    # A new floor changes the kind and climb of every edge
+    relinked = db_location.floor != floor or location.transitions is not None
     
     # Update coordinates if provided
+    moved = False
     if location.coordinates:
         point = ShapelyPoint(location.coordinates.coordinates[0], location.coordinates.coordinates[1])
+        moved = not point.equals(to_shape(db_location.coordinates))
         db_location.coordinates = f'SRID=4326;{point.wkt}'
+    else:
+        point = to_shape(db_location.coordinates)
     
-    # Update connections if provided
-    if location.connected_to is not None:
-        # Remove existing connections
-        db.execute(models.path_edges.delete().where(models.path_edges.c.from_id == location_id))
-        db.execute(models.path_edges.delete().where(models.path_edges.c.to_id == location_id))
-        
-        # Add new connections
-        for connected_id in location.connected_to:
-            connected_location = get_location(db, connected_id)
-            if connected_location:
-                # Calculate Euclidean distance between points
-                loc1_point = to_shape(db_location.coordinates)
-                loc2_point = to_shape(connected_location.coordinates)
-                distance = loc1_point.distance(loc2_point)
-                
-                # Add edge in both directions
-                stmt = models.path_edges.insert().values(
-                    from_id=db_location.id,
-                    to_id=connected_id,
-                    distance=distance
-                )
-                db.execute(stmt)
-                
-                stmt = models.path_edges.insert().values(
-                    from_id=connected_id,
-                    to_id=db_location.id,
-                    distance=distance
-                )
-                db.execute(stmt)
+    # Diff the connections against what is stored; only changed edges are written
+    added, removed = {}, []
+    if location.connected_to is not None or moved or relinked:
+        stored = _current_neighbors(db, location_id)
+        current = set(stored)
+        wanted = current if location.connected_to is None else set(location.connected_to)
+        removed = sorted(current - wanted)
+        # Kept edges only need re-measuring if the location moved or changed floor
+        measure = wanted if moved or relinked else wanted - current
+        # Kept stairways and elevators stay what they were unless overridden
+        transitions = {n: kind for n, kind in stored.items() if kind != "walk"}
+        transitions.update(location.transitions or {})
+        added, kinds = _edge_distances(db, location_id, point.x, point.y, db_location.floor, measure, transitions)
+        _delete_edges(db, location_id, removed)
+        _insert_edges(db, location_id, {n: d for n, d in added.items() if n not in current}, kinds)
+        _update_edge_distances(db, location_id, {n: d for n, d in added.items() if n in current}, kinds)
     
+    cache_versions.bump(db, LOCATIONS)
     db.commit()
     db.refresh(db_location)
+    graph_cache.update_location(location_id, db_location.name, (point.x, point.y), added, removed)
+    search_index.upsert(_location_document(db_location, point))
+    response_cache.invalidate("locations")
     return db_location
 
 def delete_location(db: Session, location_id: int):
-    # Delete connections
-    db.execute(models.path_edges.delete().where(models.path_edges.c.from_id == location_id))
-    db.execute(models.path_edges.delete().where(models.path_edges.c.to_id == location_id))
+    # Delete connections in both directions
+    edges = models.path_edges.c
+    db.execute(models.path_edges.delete().where(
+        or_(edges.from_id == location_id, edges.to_id == location_id)
+    ))
     
     # Delete POIs and emergency services related to this location
-    db.query(models.POI).filter(models.POI.location_id == location_id).delete()
-    db.query(models.EmergencyService).filter(models.EmergencyService.location_id == location_id).delete()
+    db.query(models.POI).filter(models.POI.location_id == location_id).delete(synchronize_session=False)
+    db.query(models.EmergencyService).filter(models.EmergencyService.location_id == location_id).delete(synchronize_session=False)
     
-    # Delete location
-    db_location = get_location(db, location_id)
-    db.delete(db_location)
+    # Delete location without loading it and its relationships first
+    db.query(models.Location).filter(models.Location.id == location_id).delete(synchronize_session=False)
+    cache_versions.bump(db, LOCATIONS, POI, EMERGENCY)
     db.commit()
+    graph_cache.remove_location(location_id)
+    search_index.remove(location_id)
+    response_cache.invalidate("locations", "poi", "emergency")
     return True
 
 # POI operations
 def get_poi(db: Session, poi_id: int):
     return db.query(models.POI).filter(models.POI.id == poi_id).first()
 
-def get_pois(db: Session, type: Optional[str] = None, skip: int = 0, limit: int = 100):
-    query = db.query(models.POI)
+def _poi_select(type: Optional[str] = None, skip: int = 0, limit: int = 100):
+    stmt = select(models.POI)
     if type:
-        query = query.filter(models.POI.type == type)
-    return query.offset(skip).limit(limit).all()
+        stmt = stmt.where(models.POI.type == type)
+    return stmt.offset(skip).limit(limit)
+
+def get_pois(db: Session, type: Optional[str] = None, skip: int = 0, limit: int = 100):
+    return db.execute(_poi_select(type, skip, limit)).scalars().all()
 
 def create_poi(db: Session, poi: schemas.POICreate):
     db_poi = models.POI(**poi.dict())
     db.add(db_poi)
+    cache_versions.bump(db, POI)
     db.commit()
+    response_cache.invalidate("poi")
+    routing_costs.invalidate()
     db.refresh(db_poi)
     return db_poi
 
@@ -221,30 +370,54 @@ def update_poi(db: Session, poi_id: int, poi: schemas.POICreate):
     db_poi = get_poi(db, poi_id)
     for key, value in poi.dict().items():
         setattr(db_poi, key, value)
+    cache_versions.bump(db, POI)
     db.commit()
+    response_cache.invalidate("poi")
+    routing_costs.invalidate()
     db.refresh(db_poi)
+    poi_broadcaster.publish([(db_poi.id, db_poi.type, db_poi.current_occupancy, db_poi.is_available)])
     return db_poi
 
+def publish_poi_changes(db: Session, poi_ids: List[int]):
+    # Occupancy buffer listener: push the flushed values to stream subscribers
+    if not poi_broadcaster.has_subscribers:
+        poi_broadcaster.publish(())
+        return
+    rows = db.execute(
+        select(models.POI.id, models.POI.type, models.POI.current_occupancy, models.POI.is_available)
+        .where(models.POI.id.in_(poi_ids))
+    ).all()
+    poi_broadcaster.publish(rows)
+
 def delete_poi(db: Session, poi_id: int):
     db_poi = get_poi(db, poi_id)
     db.delete(db_poi)
+    cache_versions.bump(db, POI)
     db.commit()
+    response_cache.invalidate("poi")
+    routing_costs.invalidate()
     return True
 
 # Emergency Service operations
 def get_emergency_service(db: Session, service_id: int):
     return db.query(models.EmergencyService).filter(models.EmergencyService.id == service_id).first()
 
-def get_emergency_services(db: Session, type: Optional[str] = None, skip: int = 0, limit: int = 100):
-    query = db.query(models.EmergencyService)
+def _emergency_service_select(type: Optional[str] = None, skip: int = 0, limit: int = 100):
+    stmt = select(models.EmergencyService)
     if type:
-        query = query.filter(models.EmergencyService.type == type)
-    return query.offset(skip).limit(limit).all()
+        stmt = stmt.where(models.EmergencyService.type == type)
+    return stmt.offset(skip).limit(limit)
+
+def get_emergency_services(db: Session, type: Optional[str] = None, skip: int = 0, limit: int = 100):
+    return db.execute(_emergency_service_select(type, skip, limit)).scalars().all()
 
 def create_emergency_service(db: Session, service: schemas.EmergencyServiceCreate):
     db_service = models.EmergencyService(**service.dict())
     db.add(db_service)
+    cache_versions.bump(db, EMERGENCY)
     db.commit()
+    nearest_service_index.invalidate()
+    response_cache.invalidate("emergency")
     db.refresh(db_service)
     return db_service
 
@@ -252,105 +425,172 @@ def update_emergency_service(db: Session, service_id: int, service: schemas.Emer
     db_service = get_emergency_service(db, service_id)
     for key, value in service.dict().items():
         setattr(db_service, key, value)
+    cache_versions.bump(db, EMERGENCY)
     db.commit()
+    nearest_service_index.invalidate()
+    response_cache.invalidate("emergency")
     db.refresh(db_service)
     return db_service
 
 def delete_emergency_service(db: Session, service_id: int):
     db_service = get_emergency_service(db, service_id)
     db.delete(db_service)
+    cache_versions.bump(db, EMERGENCY)
     db.commit()
+    nearest_service_index.invalidate()
+    response_cache.invalidate("emergency")
     return True
 
+# Writes made by other worker processes, reported by cache_sync. Drop what
+# they may have changed; graph_cache.invalidate() also clears every index
+# keyed on the graph version.
+def forget_locations(db: Session):
+    graph_cache.invalidate()
+    search_index.invalidate()
+    response_cache.invalidate("locations")
+
+def forget_pois(db: Session):
+    response_cache.invalidate("poi")
+    routing_costs.invalidate()
+
+def forget_occupancy(db: Session):
+    # Which POIs changed is not recorded, but re-reading all of them only
+    # patches the edges whose crowding actually moved
+    response_cache.invalidate("poi")
+    routing_costs.refresh_pois(db, None)
+
+def forget_emergency_services(db: Session):
+    nearest_service_index.invalidate()
+    response_cache.invalidate("emergency")
+
 # Pathfinding
-def calculate_path(db: Session, start_id: int, end_id: int):
+WALKING_SPEED = 1.4  # m/s, average walking speed
+
+
+def estimate_walking_time(distance: float) -> float:
     """
-    Implements Dijkstra's algorithm to find the shortest path between two locations
+    Walking time in minutes for a distance in meters
     """
-    # Get all locations and build the graph
-    locations = {loc.id: loc for loc in db.query(models.Location).all()}
-    
-    # Dictionary to store the distance from start to each node
-    distances = {loc_id: float('infinity') for loc_id in locations}
-    distances[start_id] = 0
-    
-    # Dictionary to store the previous node in optimal path
-    previous = {loc_id: None for loc_id in locations}
-    
-    # Priority queue to store vertices that need to be processed
-    # Format: (distance, location_id)
-    pq = [(0, start_id)]
-    
-    # Set to keep track of processed vertices
-    processed = set()
-    
-    while pq:
-        # Get the vertex with the smallest distance
-        current_distance, current_id = heapq.heappop(pq)
-        
-        # If we've already processed this vertex, skip
-        if current_id in processed:
-            continue
-            
-        # Mark as processed
-        processed.add(current_id)
-        
-        # If we've reached the destination, break
-        if current_id == end_id:
-            break
-            
-        # Get all connections for the current location
-        connections = db.query(models.path_edges).filter(models.path_edges.c.from_id == current_id).all()
-        
-        for conn in connections:
-            neighbor_id = conn.to_id
-            weight = conn.distance
-            
-            # If we've already processed this neighbor, skip
-            if neighbor_id in processed:
-                continue
-                
-            # Calculate new distance
-            distance = current_distance + weight
-            
-            # If this path is better than any previous path
-            if distance < distances[neighbor_id]:
-                distances[neighbor_id] = distance
-                previous[neighbor_id] = current_id
-                heapq.heappush(pq, (distance, neighbor_id))
-    
-    # Reconstruct path
-    path = []
-    current_id = end_id
-    
-    # If end_id is not reachable
-    if previous[end_id] is None and end_id != start_id:
+    return distance / WALKING_SPEED / 60
+
+
+def calculate_path(db: Session, start_id: int, end_id: int, algorithm: str = "astar",
+                   avoid_crowds: bool = False, step_free: bool = False):
+    """
+    Finds the shortest path between two locations. "ch" queries the contraction
+    hierarchy and falls back to A* while it is being loaded or (re)built; the
+    other algorithms search the cached in-memory graph directly. Neither the search
+    nor path reconstruction touches the database once the graph is loaded.
+
+    avoid_crowds and step_free search the precomputed edge costs from
+    routing_costs instead, with A* in place of the hierarchy, which only
+    knows plain distances.
+
+    "layered" runs A* over per-floor layers loaded on demand (see floors.py)
+    and never loads the whole graph; it honours step_free but not avoid_crowds.
+    """
+    if algorithm == "layered":
+        result = layered_graph.shortest_path(db, start_id, end_id, step_free=step_free)
+        if result is None:
+            return None
+        return _build_path(result, result.distance, result.path)
+
+    graph = graph_cache.get(db)
+    costs = routing_costs.costs(db, graph, avoid_crowds=avoid_crowds, step_free=step_free)
+    hierarchy = hierarchy_cache.get(db) if algorithm == "ch" and costs is None else None
+    if hierarchy is not None:
+        result = hierarchy.shortest_path(start_id, end_id)
+    else:
+        result = graph.shortest_path(start_id, end_id, algorithm="astar" if algorithm == "ch" else algorithm,
+                                     costs=costs)
+    if result is None:
         return None
-        
-    while current_id is not None:
-        location = locations[current_id]
-        coordinates_geojson = json.loads(db.scalar(ST_AsGeoJSON(location.coordinates)))
+    total_distance, path_ids = result
+    if costs is not None:
+        # The search minimised cost; report meters so the ETA stays right
+        total_distance = _path_length(graph, path_ids)
+    return _build_path(graph, total_distance, path_ids)
+
+
+def _path_length(graph, path_ids: List[int]) -> float:
+    total = 0.0
+    for from_id, to_id in zip(path_ids, path_ids[1:]):
+        total += min(distance for neighbor_id, distance in graph.adjacency[from_id] if neighbor_id == to_id)
+    return total
+
+
+def _build_path(graph, total_distance: float, path_ids: List[int]):
+    # Reconstruct path from the names and coordinates already held by the graph
+    path = []
+    for location_id in path_ids:
+        lon, lat = graph.coordinates[location_id]
         path.append(schemas.PathSegment(
-            location_id=location.id,
-            name=location.name,
-            coordinates=schemas.Point(type="Point", coordinates=[
-                coordinates_geojson["coordinates"][0],
-                coordinates_geojson["coordinates"][1]
-            ])
+            location_id=location_id,
+            name=graph.nodes[location_id],
+            coordinates=schemas.Point(type="Point", coordinates=[lon, lat])
         ))
-        current_id = previous[current_id]
-        
-    # Reverse path to get start to end
-    path.reverse()
-    
-    # Calculate total distance and estimated time
-    # Assume average walking speed of 1.4 m/s
-    total_distance = distances[end_id]
-    walking_speed = 1.4  # m/s
-    estimated_time = total_distance / walking_speed / 60  # convert to minutes
     
     return schemas.Path(
         segments=path,
         total_distance=total_distance,
-        estimated_time=estimated_time
-    )
\ No newline at end of file
+        estimated_time=estimate_walking_time(total_distance)
+    )
+
+
+def calculate_distance_matrix(db: Session, sources: List[int], targets: List[int]):
+    """
+    Walking distances from every source to every target, computed with one
+    shortest-path tree per distinct source that stops once all targets are
+    settled. Unreachable pairs are None.
+    """
+    graph = graph_cache.get(db)
+    rows = {}
+    for source_id in dict.fromkeys(sources):
+        distances, _ = graph.shortest_path_tree(source_id, targets=targets)
+        rows[source_id] = [distances.get(target_id) for target_id in targets]
+
+    distances = [rows[source_id] for source_id in sources]
+    return schemas.DistanceMatrix(
+        sources=sources,
+        targets=targets,
+        distances=distances,
+        estimated_times=[
+            [None if distance is None else estimate_walking_time(distance) for distance in row]
+            for row in distances
+        ]
+    )
+
+
+def calculate_shortest_path_tree(db: Session, start_id: int):
+    """
+    Runs (or reuses a cached) one-to-all Dijkstra from start_id and returns an
+    iterator over every reachable location, nearest first, or None if
+    start_id is not a known location.
+    """
+    tree = tree_cache.get(db, start_id)
+    if not tree:
+        return None
+    return (
+        {
+            'location_id': location_id,
+            'previous_id': previous_id,
+            'distance': distance,
+            'estimated_time': estimate_walking_time(distance)
+        }
+        for location_id, previous_id, distance in tree
+    )
+
+
+def find_nearest_emergency_service(db: Session, location_id: int, type: str):
+    """
+    Route from location_id to the closest emergency service of the given type,
+    or None if no such service is reachable
+    """
+    result = nearest_service_index.nearest(db, location_id, type)
+    if result is None:
+        return None
+    service_id, total_distance, path_ids = result
+    return schemas.EmergencyRoute(
+        service=get_emergency_service(db, service_id),
+        path=_build_path(graph_cache.get(db), total_distance, path_ids)
+    )
@@ -0,0 +1,27 @@
+# crud_async.py
+"""
+AsyncSession versions of the read-only crud functions, so the read-heavy
+endpoints can run concurrently on the event loop without a thread each.
+Statements and row conversion are shared with crud.
+
+Path calculation has no async version: it is CPU-bound once the graph is
+loaded, so /path/ stays a sync handler on the threadpool.
+"""
+from typing import Optional
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import crud
+
+
+async def get_locations(db: AsyncSession, skip: int = 0, limit: int = 100, after_id: Optional[int] = None):
+    result = await db.execute(crud._location_page_select(skip, limit, after_id))
+    return [crud._location_dict(loc) for loc in result]
+
+async def get_pois(db: AsyncSession, type: Optional[str] = None, skip: int = 0, limit: int = 100):
+    result = await db.execute(crud._poi_select(type, skip, limit))
+    return result.scalars().all()
+
+async def get_emergency_services(db: AsyncSession, type: Optional[str] = None, skip: int = 0, limit: int = 100):
+    result = await db.execute(crud._emergency_service_select(type, skip, limit))
+    return result.scalars().all()
@@ -0,0 +1,106 @@
+# csr.py
+from array import array
+from typing import Dict, Iterable, List, Optional, Tuple
+
+
+class CSRGraph:
+    """
+    Compressed sparse row adjacency over dense node indices.
+
+    The edges of node i are targets[offsets[i]:offsets[i + 1]] with the same
+    slice of weights, which costs 12 bytes per edge where dicts of tuple lists
+    cost a few hundred. Location ids map to indices through a dense array,
+    since they come from an AUTO_INCREMENT column.
+
+    Nodes whose edges changed after the arrays were built, and nodes added
+    since, keep their edges in overlay instead; compacted() folds them back
+    into fresh arrays.
+    """
+
+    def __init__(self, ids: Optional[array] = None, index: Optional[array] = None):
+        # index -> location id
+        self.ids = ids if ids is not None else array('q')
+        # location id -> index, -1 where there is none
+        self.index = index if index is not None else array('i')
+        self.offsets = array('q', [0])
+        self.targets = array('i')
+        self.weights = array('d')
+        # index -> list of (target index, weight), replacing the array slice
+        self.overlay: Dict[int, List[Tuple[int, float]]] = {}
+
+    @property
+    def base_size(self) -> int:
+        # Nodes covered by offsets; later ones live only in the overlay
+        return len(self.offsets) - 1
+
+    def index_of(self, location_id: int) -> int:
+        if 0 <= location_id < len(self.index):
+            return self.index[location_id]
+        return -1
+
+    def add_node(self, location_id: int) -> int:
+        if location_id >= len(self.index):
+            self.index.extend(array('i', [-1]) * (location_id + 1 - len(self.index)))
+        position = len(self.ids)
+        self.ids.append(location_id)
+        self.index[location_id] = position
+        return position
+
+    def drop_id(self, location_id: int):
+        if 0 <= location_id < len(self.index):
+            self.index[location_id] = -1
+
+    def edges(self, position: int):
+        """
+        (target index, weight) pairs of a node
+        """
+        edges = self.overlay.get(position)
+        if edges is not None:
+            return edges
+        if position < len(self.offsets) - 1:
+            start, stop = self.offsets[position], self.offsets[position + 1]
+            return list(zip(self.targets[start:stop], self.weights[start:stop]))
+        return []
+
+    def fill(self, sources: Iterable[int], targets: Iterable[int], weights: Iterable[float]):
+        """
+        Builds offsets, targets and weights from parallel edge lists given by
+        index, with a counting sort over the source indices
+        """
+        sources = array('i', sources)
+        size = len(self.ids)
+        offsets = array('q', [0]) * (size + 1)
+        for source in sources:
+            offsets[source + 1] += 1
+        for position in range(size):
+            offsets[position + 1] += offsets[position]
+
+        slots = array('q', offsets)
+        ordered_targets = array('i', [0]) * len(sources)
+        ordered_weights = array('d', [0.0]) * len(sources)
+        for source, target, weight in zip(sources, targets, weights):
+            slot = slots[source]
+            ordered_targets[slot] = target
+            ordered_weights[slot] = weight
+            slots[source] = slot + 1
+
+        self.offsets = offsets
+        self.targets = ordered_targets
+        self.weights = ordered_weights
+        self.overlay = {}
+
+    def compacted(self) -> "CSRGraph":
+        # Shares the id arrays, so indices stay valid
+        compact = CSRGraph(self.ids, self.index)
+        sources, targets, weights = array('i'), array('i'), array('d')
+        for position in range(len(self.ids)):
+            for target, weight in self.edges(position):
+                sources.append(position)
+                targets.append(target)
+                weights.append(weight)
+        compact.fill(sources, targets, weights)
+        return compact
+
+    def memory_bytes(self) -> int:
+        arrays = (self.ids, self.index, self.offsets, self.targets, self.weights)
+        return sum(len(values) * values.itemsize for values in arrays)
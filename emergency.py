@@ -0,0 +1,113 @@
+# emergency.py
+import threading
+from array import array
+from typing import Dict, List, Optional, Tuple
+
+import models
+from graph import graph_cache
+
+
+class ServiceField:
+    """
+    The nearest-service field of one type: per CSR index, the distance to the
+    closest service and the index it is reached from (-1 at a service or when
+    unreachable), in two flat arrays like ShortestPathTree.
+    """
+
+    def __init__(self, version: int, services: Dict[int, int], csr, tree):
+        self.version = version
+        # location_id -> service_id, one service per location
+        self.services = services
+        # Shared with the graph, so indices stay valid until the next change
+        self._ids = csr.ids
+        self._index = csr.index
+        size = len(csr.ids)
+        self.distances = array('d', [float('infinity')]) * size
+        self.parents = array('i', [-1]) * size
+        for position, parent, distance in zip(tree.order, tree.parents, tree.distances):
+            self.distances[position] = distance
+            self.parents[position] = parent
+
+    def walk(self, location_id: int) -> Optional[Tuple[int, float, List[int]]]:
+        if not 0 <= location_id < len(self._index):
+            return None
+        position = self._index[location_id]
+        if position < 0 or position >= len(self.distances) or self.distances[position] == float('infinity'):
+            return None
+
+        ids, parents = self._ids, self.parents
+        path = [location_id]
+        parent = parents[position]
+        while parent >= 0:
+            path.append(ids[parent])
+            parent = parents[parent]
+        return self.services[path[-1]], self.distances[position], path
+
+
+class NearestServiceIndex:
+    """
+    For each emergency service type, a multi-source Dijkstra run outward from
+    every location that hosts a service of that type. Because path_edges are
+    symmetric, following a location's predecessor chain walks it to its
+    nearest service, so each request is an array walk instead of a search.
+
+    Entries are rebuilt lazily after graph changes or emergency service writes,
+    which keeps request spikes (e.g. during drills) off the database. Only one
+    request rebuilds a type; the others wait for its result.
+    """
+
+    def __init__(self, graph_cache):
+        self._graph_cache = graph_cache
+        self._lock = threading.Lock()
+        # type -> ServiceField
+        self._fields: Dict[str, ServiceField] = {}
+        # type -> lock held while that type's field is built
+        self._build_locks: Dict[str, threading.Lock] = {}
+        # Bumped by invalidate() so a build racing with a write is not stored
+        self._generation = 0
+        graph_cache.add_listener(self.invalidate)
+
+    def invalidate(self, change=None):
+        with self._lock:
+            self._fields.clear()
+            self._generation += 1
+
+    def _field(self, db, service_type: str) -> ServiceField:
+        field = self._fields.get(service_type)
+        if field is not None and field.version == self._graph_cache.version:
+            return field
+
+        with self._lock:
+            build_lock = self._build_locks.setdefault(service_type, threading.Lock())
+        with build_lock:
+            version = self._graph_cache.version
+            generation = self._generation
+            field = self._fields.get(service_type)
+            if field is not None and field.version == version:
+                return field
+
+            graph = self._graph_cache.get(db)
+            services: Dict[int, int] = {}
+            rows = db.query(models.EmergencyService.id, models.EmergencyService.location_id).filter(
+                models.EmergencyService.type == service_type
+            ).order_by(models.EmergencyService.id)
+            for service_id, location_id in rows:
+                services.setdefault(location_id, service_id)
+
+            tree = graph.settled_forest(services)
+            # Read after the search; the id array only grows, so it covers the tree
+            field = ServiceField(version, services, graph.csr, tree)
+            with self._lock:
+                if self._graph_cache.version == version and self._generation == generation:
+                    self._fields[service_type] = field
+            return field
+
+    def nearest(self, db, location_id: int, service_type: str) -> Optional[Tuple[int, float, List[int]]]:
+        """
+        Returns (service_id, distance, [location_id, ...]) for the closest
+        service of the given type, or None if none is reachable
+        """
+        return self._field(db, service_type).walk(location_id)
+
+
+nearest_service_index = NearestServiceIndex(graph_cache)
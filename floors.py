@@ -0,0 +1,258 @@
+# floors.py
+import heapq
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from graph import graph_cache, haversine
+from wkb import point_from_wkb
+
+# path_edges.kind. Anything but "walk" links two floors.
+EDGE_KINDS = ("walk", "stairs", "elevator", "ramp", "escalator")
+# Assumed for an edge between floors when no kind is given
+DEFAULT_VERTICAL_KIND = "stairs"
+# Walking-equivalent meters added per floor climbed, on top of the
+# horizontal distance; the elevator figure includes the wait
+VERTICAL_COST_M = {"stairs": 12.0, "elevator": 20.0, "ramp": 10.0, "escalator": 8.0}
+# Kinds a step-free route must not use
+STEP_KINDS = frozenset(("stairs", "escalator"))
+# Floor layers kept in memory at once
+LAYER_CACHE_SIZE = 64
+# Lower bound of edge distance / great-circle meters. The layered search reads
+# path_edges.kind, which only exists once recompute_edge_distances.py has
+# rewritten every edge as haversine meters plus climb_cost (or on tables
+# created since), so no edge is shorter than the distance between its ends.
+HEURISTIC_SCALE = 1.0
+
+# (building, floor); either may be None, e.g. (None, None) for outdoor paths
+LayerKey = Tuple[Optional[str], Optional[int]]
+
+
+def edge_kind(from_floor: Optional[int], to_floor: Optional[int], requested: Optional[str] = None) -> str:
+    if from_floor is None or to_floor is None or from_floor == to_floor:
+        return "walk"
+    return requested or DEFAULT_VERTICAL_KIND
+
+
+def climb_cost(kind: str, from_floor: Optional[int], to_floor: Optional[int]) -> float:
+    if kind not in VERTICAL_COST_M or from_floor is None or to_floor is None:
+        return 0.0
+    return VERTICAL_COST_M[kind] * abs(to_floor - from_floor)
+
+
+class FloorLayer:
+    """
+    The locations of one floor of one building, with every edge leaving them
+    """
+
+    def __init__(self, key: LayerKey):
+        self.key = key
+        # location_id -> name, for this layer's own locations
+        self.nodes: Dict[int, str] = {}
+        # location_id -> (longitude, latitude), also for the far ends of edges
+        # leaving the layer, so searches can estimate them before loading
+        self.coordinates: Dict[int, Tuple[float, float]] = {}
+        # location_id -> list of (neighbor_id, distance, kind)
+        self.adjacency: Dict[int, List[Tuple[int, float, str]]] = {}
+
+    @classmethod
+    def load(cls, db, key: LayerKey, layer_of: Dict[int, LayerKey]):
+        """
+        Loads the layer and records the layer of every neighbouring location
+        in layer_of
+        """
+        from sqlalchemy import and_, func, select
+        import models
+
+        building, floor = key
+        locations = models.Location.__table__
+        targets = locations.alias("targets")
+        edges = models.path_edges
+
+        def in_layer(table):
+            return and_(
+                table.c.building.is_(None) if building is None else table.c.building == building,
+                table.c.floor.is_(None) if floor is None else table.c.floor == floor,
+            )
+
+        layer = cls(key)
+        rows = db.execute(
+            select(locations.c.id, locations.c.name, func.ST_AsBinary(locations.c.coordinates))
+            .where(in_layer(locations))
+        )
+        for loc_id, name, coordinates in rows:
+            layer.nodes[loc_id] = name
+            layer.coordinates[loc_id] = point_from_wkb(coordinates)
+            layer.adjacency[loc_id] = []
+            layer_of[loc_id] = key
+
+        rows = db.execute(
+            select(
+                edges.c.from_id, edges.c.to_id, edges.c.distance, edges.c.kind,
+                targets.c.building, targets.c.floor, func.ST_AsBinary(targets.c.coordinates),
+            )
+            .select_from(
+                edges.join(locations, locations.c.id == edges.c.from_id)
+                .join(targets, targets.c.id == edges.c.to_id)
+            )
+            .where(in_layer(locations))
+        )
+        for from_id, to_id, distance, kind, to_building, to_floor, coordinates in rows:
+            layer.adjacency[from_id].append((to_id, distance, kind))
+            if to_id not in layer.nodes:
+                layer.coordinates[to_id] = point_from_wkb(coordinates)
+                layer_of[to_id] = (to_building, to_floor)
+        return layer
+
+
+class FloorPath:
+    """
+    A route through the layered graph, with the names and coordinates of the
+    locations on it
+    """
+
+    def __init__(self, distance: float, path: List[int], nodes: Dict[int, str],
+                 coordinates: Dict[int, Tuple[float, float]]):
+        self.distance = distance
+        self.path = path
+        self.nodes = nodes
+        self.coordinates = coordinates
+
+
+class LayeredGraph:
+    """
+    The walking graph split into per-floor layers that are loaded on demand.
+
+    A search starts with the layers of its two ends and loads another floor
+    only when it settles a location there, usually by taking a stairway or
+    elevator edge. A route inside one tall building therefore reads a few
+    floors instead of the whole campus. Layers are kept in an LRU cache and
+    dropped on every graph change.
+    """
+
+    def __init__(self, graph_cache, max_layers: int = LAYER_CACHE_SIZE):
+        self._lock = threading.Lock()
+        self._layers: "OrderedDict[LayerKey, FloorLayer]" = OrderedDict()
+        # location_id -> layer key, for every location seen so far
+        self._layer_of: Dict[int, LayerKey] = {}
+        self.max_layers = max_layers
+        # Bumped by invalidate() so a load racing with a write is not stored
+        self._generation = 0
+        graph_cache.add_listener(self.invalidate)
+
+    def invalidate(self, change=None):
+        with self._lock:
+            self._layers.clear()
+            self._layer_of = {}
+            self._generation += 1
+
+    def layer(self, db, key: LayerKey, layer_of: Optional[Dict[int, LayerKey]] = None) -> FloorLayer:
+        """
+        The layer for key, loaded if needed. Layers of neighbouring locations
+        are recorded in layer_of, by default the shared map.
+        """
+        with self._lock:
+            layer = self._layers.get(key)
+            if layer is not None:
+                self._layers.move_to_end(key)
+                return layer
+            generation = self._generation
+            shared = self._layer_of
+        layer = FloorLayer.load(db, key, shared)
+        if layer_of is not None and layer_of is not shared:
+            layer_of.update(shared)
+        with self._lock:
+            if self._generation == generation:
+                self._layers[key] = layer
+                while len(self._layers) > self.max_layers:
+                    self._layers.popitem(last=False)
+        return layer
+
+    def _locate(self, db, layer_of: Dict[int, LayerKey], location_ids):
+        missing = [loc_id for loc_id in location_ids if loc_id not in layer_of]
+        if missing:
+            from sqlalchemy import select
+            import models
+
+            rows = db.execute(
+                select(models.Location.id, models.Location.building, models.Location.floor)
+                .where(models.Location.id.in_(missing))
+            )
+            for loc_id, building, floor in rows:
+                layer_of[loc_id] = (building, floor)
+
+    def shortest_path(self, db, start_id: int, end_id: int, step_free: bool = False) -> Optional[FloorPath]:
+        """
+        A* over the layers, loading each floor the first time the search
+        settles a location on it. step_free skips stairs and escalators.
+        The heuristic is the great-circle distance times HEURISTIC_SCALE.
+        """
+        layer_of = self._layer_of
+        self._locate(db, layer_of, (start_id, end_id))
+        touched: Dict[LayerKey, FloorLayer] = {}
+
+        def layer_for(location_id) -> Optional[FloorLayer]:
+            key = layer_of.get(location_id)
+            if key is None:
+                # Only after a graph change raced with this search
+                self._locate(db, layer_of, (location_id,))
+                key = layer_of.get(location_id)
+                if key is None:
+                    return None
+            layer = touched.get(key)
+            if layer is None:
+                layer = touched[key] = self.layer(db, key, layer_of)
+            return layer
+
+        start_layer = layer_for(start_id)
+        end_layer = layer_for(end_id)
+        if start_layer is None or end_layer is None or start_id not in start_layer.nodes or end_id not in end_layer.nodes:
+            return None
+        end_lon, end_lat = end_layer.coordinates[end_id]
+        scale = HEURISTIC_SCALE
+
+        distances = {start_id: 0.0}
+        previous = {start_id: None}
+        processed = set()
+        pq = [(0.0, start_id)]
+        while pq:
+            _, current_id = heapq.heappop(pq)
+            if current_id in processed:
+                continue
+            processed.add(current_id)
+            if current_id == end_id:
+                break
+
+            layer = layer_for(current_id)
+            if layer is None:
+                continue
+            current_distance = distances[current_id]
+            for neighbor_id, weight, kind in layer.adjacency.get(current_id, ()):
+                if neighbor_id in processed or (step_free and kind in STEP_KINDS):
+                    continue
+                distance = current_distance + weight
+                if distance < distances.get(neighbor_id, float('infinity')):
+                    distances[neighbor_id] = distance
+                    previous[neighbor_id] = current_id
+                    lon, lat = layer.coordinates[neighbor_id]
+                    heapq.heappush(pq, (distance + scale * haversine(lon, lat, end_lon, end_lat), neighbor_id))
+
+        if end_id not in processed:
+            return None
+
+        path = []
+        current_id = end_id
+        while current_id is not None:
+            path.append(current_id)
+            current_id = previous[current_id]
+        path.reverse()
+        nodes = {}
+        coordinates = {}
+        for location_id in path:
+            layer = touched[layer_of[location_id]]
+            nodes[location_id] = layer.nodes.get(location_id, "")
+            coordinates[location_id] = layer.coordinates[location_id]
+        return FloorPath(distances[end_id], path, nodes, coordinates)
+
+
+layered_graph = LayeredGraph(graph_cache)
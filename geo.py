@@ -0,0 +1,17 @@
+# geo.py
+import numpy as np
+
+from graph import EARTH_RADIUS_M
+
+
+def haversine_distances(lon1, lat1, lon2, lat2):
+    """
+    Vectorized great-circle distance in meters between WGS84 coordinates;
+    arguments broadcast like NumPy arrays
+    """
+    phi1 = np.radians(lat1)
+    phi2 = np.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = np.radians(np.asarray(lon2, dtype=float) - lon1)
+    a = np.sin(dphi / 2) ** 2 + np.cos(phi1) * np.cos(phi2) * np.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.minimum(1.0, np.sqrt(a)))
@@ -0,0 +1,708 @@
+# graph.py
+import heapq
+import math
+import threading
+from array import array
+from collections import OrderedDict
+from collections.abc import Mapping
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from csr import CSRGraph
+from wkb import point_from_wkb
+
+EARTH_RADIUS_M = 6371008.8
+
+ALGORITHMS = ("dijkstra", "astar", "bidirectional", "bidirectional_astar")
+
+# Patched nodes tolerated in the CSR overlay before it is folded back in
+COMPACT_MIN_OVERLAY = 1024
+
+
+def haversine(lon1: float, lat1: float, lon2: float, lat2: float) -> float:
+    """
+    Great-circle distance in meters between two WGS84 points
+    """
+    phi1 = math.radians(lat1)
+    phi2 = math.radians(lat2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(lon2 - lon1)
+    a = math.sin(dphi / 2) ** 2 + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(a)))
+
+
+class GraphChange:
+    """
+    One write to the walking graph, as passed to graph_cache listeners.
+
+    kind is "add", "update" or "remove" for a single location, or "reload"
+    when the whole graph was dropped. added maps neighbour ids to the new
+    distance of edges that were created or re-measured; removed lists
+    neighbours whose edges were dropped. Edges are symmetric, so both lists
+    describe the edge in both directions.
+    """
+
+    def __init__(self, kind: str, location_id: Optional[int] = None, name: Optional[str] = None,
+                 coordinates: Optional[Tuple[float, float]] = None,
+                 added: Optional[Dict[int, float]] = None, removed=(), moved: bool = False):
+        self.kind = kind
+        self.location_id = location_id
+        self.name = name
+        self.coordinates = coordinates
+        self.added = added or {}
+        self.removed = list(removed)
+        self.moved = moved
+        # Set by GraphCache when the change is applied
+        self.version = None
+
+
+class _NodesView(Mapping):
+    # location_id -> name
+    def __init__(self, graph):
+        self._graph = graph
+
+    def __getitem__(self, location_id):
+        position = self._graph._position(location_id)
+        if position < 0:
+            raise KeyError(location_id)
+        return self._graph.names[position]
+
+    def __contains__(self, location_id):
+        return self._graph._position(location_id) >= 0
+
+    def __iter__(self):
+        graph = self._graph
+        ids = graph.csr.ids
+        for position, name in enumerate(list(graph.names)):
+            if name is not None:
+                yield ids[position]
+
+    def __len__(self):
+        return self._graph.size
+
+
+class _CoordinatesView(_NodesView):
+    # location_id -> (longitude, latitude)
+    def __getitem__(self, location_id):
+        position = self._graph._position(location_id)
+        if position < 0:
+            raise KeyError(location_id)
+        return self._graph.lons[position], self._graph.lats[position]
+
+
+class _AdjacencyView(_NodesView):
+    # location_id -> list of (neighbor_id, distance)
+    def __getitem__(self, location_id):
+        position = self._graph._position(location_id)
+        if position < 0:
+            raise KeyError(location_id)
+        csr = self._graph.csr
+        ids = csr.ids
+        return [(ids[target], weight) for target, weight in csr.edges(position)]
+
+
+class CampusGraph:
+    """
+    In-memory copy of the walking graph stored in ``locations`` and ``path_edges``.
+
+    Edges are held in a CSRGraph and searched in index space. nodes,
+    coordinates and adjacency are read-only mappings by location id for
+    everything off the hot path. Writes patch the CSR overlay and fold it
+    back into the arrays once it grows.
+    """
+
+    def __init__(self):
+        self.csr = CSRGraph()
+        # index -> location name, None once the location is removed
+        self.names: List[Optional[str]] = []
+        self.lons = array('d')
+        self.lats = array('d')
+        self.size = 0
+        # Lower bound of edge distance / great-circle meters over all edges.
+        # Scaling the haversine heuristic by it keeps A* admissible whatever
+        # unit path_edges.distance is stored in.
+        self.heuristic_scale = float('infinity')
+        self.nodes = _NodesView(self)
+        self.coordinates = _CoordinatesView(self)
+        self.adjacency = _AdjacencyView(self)
+
+    @classmethod
+    def load(cls, db):
+        # Imported here so the graph itself can be built and benchmarked
+        # without a database connection
+        from sqlalchemy import func
+        import models
+
+        locations = db.query(models.Location.id, models.Location.name, func.ST_AsBinary(models.Location.coordinates))
+        edges = db.query(
+            models.path_edges.c.from_id,
+            models.path_edges.c.to_id,
+            models.path_edges.c.distance,
+        )
+        return cls.from_rows(
+            ((loc_id, name, point_from_wkb(coordinates)) for loc_id, name, coordinates in locations),
+            edges,
+        )
+
+    @classmethod
+    def from_rows(cls, locations, edges):
+        """
+        Builds the graph from (location_id, name, (lon, lat)) and
+        (from_id, to_id, distance) rows, streaming both into arrays
+        """
+        graph = cls()
+        for loc_id, name, (lon, lat) in locations:
+            graph._add_position(loc_id, name, lon, lat)
+
+        csr = graph.csr
+        sources, targets, weights = array('i'), array('i'), array('d')
+        for from_id, to_id, distance in edges:
+            source = csr.index_of(from_id)
+            target = csr.index_of(to_id)
+            if source >= 0 and target >= 0:
+                sources.append(source)
+                targets.append(target)
+                weights.append(distance)
+                graph._observe_edge(source, target, distance)
+        csr.fill(sources, targets, weights)
+        return graph
+
+    def _position(self, location_id: int) -> int:
+        return self.csr.index_of(location_id)
+
+    def _add_position(self, location_id: int, name: str, lon: float, lat: float) -> int:
+        position = self.csr.add_node(location_id)
+        self.names.append(name)
+        self.lons.append(lon)
+        self.lats.append(lat)
+        self.size += 1
+        return position
+
+    def _observe_edge(self, source: int, target: int, distance: float):
+        meters = haversine(self.lons[source], self.lats[source], self.lons[target], self.lats[target])
+        if meters > 0:
+            self.heuristic_scale = min(self.heuristic_scale, distance / meters)
+
+    def _place(self, location_id: int, name: str, coordinates: Tuple[float, float]) -> int:
+        position = self._position(location_id)
+        if position < 0:
+            return self._add_position(location_id, name, *coordinates)
+        self.names[position] = name
+        self.lons[position], self.lats[position] = coordinates
+        return position
+
+    def add_node(self, location_id: int, name: str, coordinates: Tuple[float, float],
+                 neighbors: Dict[int, float]):
+        self._place(location_id, name, coordinates)
+        self.set_neighbors(location_id, neighbors)
+
+    def set_neighbors(self, location_id: int, neighbors: Dict[int, float]):
+        """
+        Replace the edges of a node, keeping the reverse edges symmetric
+        """
+        position = self._position(location_id)
+        if position < 0:
+            return
+        csr = self.csr
+        for target, _ in csr.edges(position):
+            if target != position:
+                csr.overlay[target] = [edge for edge in csr.edges(target) if edge[0] != position]
+
+        own = []
+        for neighbor_id, distance in neighbors.items():
+            target = self._position(neighbor_id)
+            if target < 0:
+                continue
+            own.append((target, distance))
+            csr.overlay[target] = csr.edges(target) + [(position, distance)]
+            self._observe_edge(position, target, distance)
+        csr.overlay[position] = own
+        self._compact_if_needed()
+
+    def apply(self, change: GraphChange):
+        """
+        Patch the graph in place with a single-location change
+        """
+        location_id = change.location_id
+        if change.kind == "remove":
+            self.remove_node(location_id)
+            return
+        position = self._place(location_id, change.name, change.coordinates)
+        csr = self.csr
+
+        dropped = {self._position(neighbor_id) for neighbor_id in set(change.removed) | change.added.keys()}
+        dropped.discard(-1)
+        own = csr.edges(position)
+        if dropped:
+            own = [edge for edge in own if edge[0] not in dropped]
+            for target in dropped:
+                csr.overlay[target] = [edge for edge in csr.edges(target) if edge[0] != position]
+        for neighbor_id, distance in change.added.items():
+            target = self._position(neighbor_id)
+            if target < 0:
+                continue
+            own = own + [(target, distance)]
+            csr.overlay[target] = csr.edges(target) + [(position, distance)]
+            self._observe_edge(position, target, distance)
+        csr.overlay[position] = own
+        self._compact_if_needed()
+
+    def remove_node(self, location_id: int):
+        position = self._position(location_id)
+        if position < 0:
+            return
+        self.set_neighbors(location_id, {})
+        self.names[position] = None
+        self.csr.drop_id(location_id)
+        self.size -= 1
+
+    def _compact_if_needed(self):
+        # Searches hold on to the CSRGraph they started with, so swapping in a
+        # compacted one never changes its offsets, targets or weights under
+        # them. ids and the overlay are still shared and patched in place,
+        # which is why the searches skip indices added after they started.
+        if len(self.csr.overlay) > max(COMPACT_MIN_OVERLAY, len(self.names) // 8):
+            self.csr = self.csr.compacted()
+
+    def memory_bytes(self) -> int:
+        return self.csr.memory_bytes() + (len(self.lons) + len(self.lats)) * 8
+
+    def _edge_arrays(self, costs=None):
+        """
+        (csr, weights, overlay) to search: the distances, or the edge costs
+        from routing_costs, which carry the CSRGraph they were built for
+        """
+        if costs is None:
+            csr = self.csr
+            return csr, csr.weights, csr.overlay
+        return costs.csr, costs.weights, costs.overlay
+
+    def _heuristic(self, end: int):
+        scale = self.heuristic_scale
+        if scale == float('infinity'):
+            return None
+        lons, lats = self.lons, self.lats
+        end_lon, end_lat = lons[end], lats[end]
+
+        def estimate(position):
+            return scale * haversine(lons[position], lats[position], end_lon, end_lat)
+        return estimate
+
+    def _bidirectional_potential(self, start: int, end: int):
+        """
+        Average potential (h_end - h_start) / 2 used by bidirectional A*.
+        The reverse search uses its negation, so both stay consistent.
+        """
+        to_end = self._heuristic(end)
+        to_start = self._heuristic(start)
+        if to_end is None or to_start is None:
+            return None
+
+        def potential(position):
+            return (to_end(position) - to_start(position)) / 2
+        return potential
+
+    def shortest_path(self, start_id: int, end_id: int, algorithm: str = "dijkstra",
+                      costs=None) -> Optional[Tuple[float, List[int]]]:
+        """
+        Dijkstra's algorithm, or A* guided by the great-circle distance to end_id,
+        over the edge distances, or over costs if given (edge costs from
+        routing_costs, built over this graph, which never undercut the distances).
+        Returns (total_cost, [location_id, ...]) or None if unreachable.
+        """
+        if algorithm not in ALGORITHMS:
+            raise ValueError(f"Unknown routing algorithm: {algorithm}")
+        start = self._position(start_id)
+        end = self._position(end_id)
+        if start < 0 or end < 0:
+            return None
+        if algorithm.startswith("bidirectional"):
+            return self._bidirectional_path(start, end, algorithm == "bidirectional_astar", costs)
+
+        heuristic = self._heuristic(end) if algorithm == "astar" else None
+        csr, weights, overlay = self._edge_arrays(costs)
+        offsets, targets = csr.offsets, csr.targets
+        base_size = csr.base_size
+
+        size = len(csr.ids)
+        distances = array('d', [float('infinity')]) * size
+        previous = array('i', [-1]) * size
+        processed = bytearray(size)
+        distances[start] = 0.0
+        # Format: (priority, index); priority is distance + heuristic for A*
+        pq = [(0.0, start)]
+
+        while pq:
+            _, current = heapq.heappop(pq)
+            if processed[current]:
+                continue
+            processed[current] = 1
+
+            if current == end:
+                break
+
+            edges = overlay.get(current)
+            if edges is None:
+                if current >= base_size:
+                    continue
+                first, last = offsets[current], offsets[current + 1]
+                edges = zip(targets[first:last], weights[first:last])
+            current_distance = distances[current]
+            for neighbor, weight in edges:
+                # Overlay edges can point at a location added since the search started
+                if neighbor >= size or processed[neighbor]:
+                    continue
+                distance = current_distance + weight
+                if distance < distances[neighbor]:
+                    distances[neighbor] = distance
+                    previous[neighbor] = current
+                    priority = distance + heuristic(neighbor) if heuristic else distance
+                    heapq.heappush(pq, (priority, neighbor))
+
+        if not processed[end]:
+            return None
+
+        ids = csr.ids
+        path = []
+        current = end
+        while current >= 0:
+            path.append(ids[current])
+            current = previous[current]
+        path.reverse()
+        return distances[end], path
+
+    def shortest_path_tree(self, start_id: int, targets=None,
+                           costs=None) -> Tuple[Dict[int, float], Dict[int, Optional[int]]]:
+        """
+        One-to-many Dijkstra from start_id. Stops early once every id in
+        targets is settled, otherwise explores everything reachable.
+        Returns (distances, previous) for the settled locations.
+        """
+        return self.multi_source_tree([start_id], targets, costs)
+
+    def multi_source_tree(self, source_ids, targets=None,
+                          costs=None) -> Tuple[Dict[int, float], Dict[int, Optional[int]]]:
+        """
+        Dijkstra seeded with every id in source_ids at distance 0, so each
+        settled location ends up with its distance to the nearest source and
+        a predecessor chain leading back to that source.
+        """
+        tree = self._settle(source_ids, targets, costs)
+        distances = {}
+        previous = {}
+        for location_id, previous_id, distance in tree:
+            distances[location_id] = distance
+            previous[location_id] = previous_id
+        return distances, previous
+
+    def settled_tree(self, start_id: int, costs=None) -> "ShortestPathTree":
+        """
+        One-to-all Dijkstra from start_id, kept as flat arrays for caching
+        """
+        return self._settle([start_id], None, costs)
+
+    def settled_forest(self, source_ids, costs=None) -> "ShortestPathTree":
+        """
+        Multi-source Dijkstra from every id in source_ids, kept as flat
+        arrays; each parent chain ends at the nearest source
+        """
+        return self._settle(source_ids, None, costs)
+
+    def _settle(self, source_ids, targets=None, costs=None) -> "ShortestPathTree":
+        csr, weights, overlay = self._edge_arrays(costs)
+        offsets, edge_targets, ids = csr.offsets, csr.targets, csr.ids
+        base_size = csr.base_size
+        sources = [position for position in map(self._position, source_ids) if position >= 0]
+        remaining = None
+        if targets is not None:
+            remaining = {position for position in map(self._position, targets) if position >= 0}
+
+        size = len(ids)
+        tentative = array('d', [float('infinity')]) * size
+        parent = array('i', [-1]) * size
+        settled = bytearray(size)
+        # Filled in the order locations are settled
+        order = array('i')
+        distances = array('d')
+        for position in sources:
+            tentative[position] = 0.0
+        pq = [(0.0, position) for position in sources]
+
+        while pq:
+            current_distance, current = heapq.heappop(pq)
+            if settled[current]:
+                continue
+            settled[current] = 1
+            order.append(current)
+            distances.append(current_distance)
+
+            if remaining is not None:
+                remaining.discard(current)
+                if not remaining:
+                    break
+
+            edges = overlay.get(current)
+            if edges is None:
+                if current >= base_size:
+                    continue
+                first, last = offsets[current], offsets[current + 1]
+                edges = zip(edge_targets[first:last], weights[first:last])
+            for neighbor, weight in edges:
+                # Overlay edges can point at a location added since the search started
+                if neighbor >= size or settled[neighbor]:
+                    continue
+                distance = current_distance + weight
+                if distance < tentative[neighbor]:
+                    tentative[neighbor] = distance
+                    parent[neighbor] = current
+                    heapq.heappush(pq, (distance, neighbor))
+
+        parents = array('i', (parent[position] for position in order))
+        return ShortestPathTree(ids, order, distances, parents)
+
+    def _bidirectional_path(self, start: int, end: int, use_heuristic: bool,
+                            costs=None) -> Optional[Tuple[float, List[int]]]:
+        """
+        Runs the search from both ends and stops once the two frontiers can no
+        longer improve on the best meeting point found so far.
+
+        The backward search walks the same edges as the forward one, which is
+        correct because path_edges always stores both directions.
+        """
+        csr, weights, overlay = self._edge_arrays(costs)
+        ids = csr.ids
+        if start == end:
+            return 0.0, [ids[start]]
+
+        potential = self._bidirectional_potential(start, end) if use_heuristic else None
+        offsets, targets = csr.offsets, csr.targets
+        base_size = csr.base_size
+        size = len(ids)
+
+        # Index 0 is the forward search from start, 1 the backward search from end
+        distances = (array('d', [float('infinity')]) * size, array('d', [float('infinity')]) * size)
+        previous = (array('i', [-1]) * size, array('i', [-1]) * size)
+        processed = (bytearray(size), bytearray(size))
+        distances[0][start] = 0.0
+        distances[1][end] = 0.0
+        sign = (1, -1)
+        if potential:
+            queues = ([(potential(start), start)], [(-potential(end), end)])
+        else:
+            queues = ([(0.0, start)], [(0.0, end)])
+
+        best = float('infinity')
+        meeting = -1
+
+        while queues[0] and queues[1]:
+            # Keys are distance +/- potential; the potentials cancel in the sum,
+            # so the usual bidirectional stopping rule applies unchanged
+            if queues[0][0][0] + queues[1][0][0] >= best:
+                break
+
+            side = 0 if len(queues[0]) <= len(queues[1]) else 1
+            _, current = heapq.heappop(queues[side])
+            own_processed = processed[side]
+            if own_processed[current]:
+                continue
+            own_processed[current] = 1
+
+            edges = overlay.get(current)
+            if edges is None:
+                if current >= base_size:
+                    continue
+                first, last = offsets[current], offsets[current + 1]
+                edges = zip(targets[first:last], weights[first:last])
+            own_distances = distances[side]
+            other_distances = distances[1 - side]
+            own_previous = previous[side]
+            current_distance = own_distances[current]
+            for neighbor, weight in edges:
+                # Overlay edges can point at a location added since the search started
+                if neighbor >= size or own_processed[neighbor]:
+                    continue
+                distance = current_distance + weight
+                if distance < own_distances[neighbor]:
+                    own_distances[neighbor] = distance
+                    own_previous[neighbor] = current
+                    key = distance + sign[side] * potential(neighbor) if potential else distance
+                    heapq.heappush(queues[side], (key, neighbor))
+
+                total = own_distances[neighbor] + other_distances[neighbor]
+                if total < best:
+                    best = total
+                    meeting = neighbor
+
+        if meeting < 0:
+            return None
+
+        path = []
+        current = meeting
+        while current >= 0:
+            path.append(ids[current])
+            current = previous[0][current]
+        path.reverse()
+        current = previous[1][meeting]
+        while current >= 0:
+            path.append(ids[current])
+            current = previous[1][current]
+        return best, path
+
+
+class GraphCache:
+    """
+    Process-level cache of the CampusGraph.
+
+    The graph is loaded lazily on first use. Location writes in crud either patch
+    the cached graph in place or invalidate it so the next request reloads it.
+    Each worker process holds its own copy.
+
+    Callables registered with add_listener() are called with the GraphChange
+    after every write, so structures derived from the graph can patch or
+    refresh themselves.
+    """
+
+    def __init__(self):
+        self._graph: Optional[CampusGraph] = None
+        self._lock = threading.Lock()
+        self._listeners = []
+        self.version = 0
+
+    def get(self, db) -> CampusGraph:
+        graph = self._graph
+        if graph is None:
+            with self._lock:
+                if self._graph is None:
+                    self._graph = CampusGraph.load(db)
+                graph = self._graph
+        return graph
+
+    def snapshot(self) -> Optional[Tuple[int, CSRGraph, bytearray]]:
+        """
+        Returns (version, compacted copy of the CSRGraph, 1 per index whose
+        location still exists), or None if the graph is not loaded. The copy
+        is taken under the write lock, so it never holds half a change.
+        """
+        with self._lock:
+            if self._graph is None:
+                return None
+            graph = self._graph
+            alive = bytearray(name is not None for name in graph.names)
+            return self.version, graph.csr.compacted(), alive
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def _changed(self, change: GraphChange):
+        for listener in self._listeners:
+            listener(change)
+
+    def invalidate(self):
+        change = GraphChange("reload")
+        with self._lock:
+            self._graph = None
+            self.version += 1
+            change.version = self.version
+        self._changed(change)
+
+    def apply(self, change: GraphChange):
+        with self._lock:
+            if self._graph is not None:
+                if change.kind == "update":
+                    change.moved = self._graph.coordinates.get(change.location_id) != change.coordinates
+                self._graph.apply(change)
+            self.version += 1
+            change.version = self.version
+        self._changed(change)
+
+    def add_location(self, location_id: int, name: str, coordinates: Tuple[float, float],
+                     neighbors: Dict[int, float]):
+        self.apply(GraphChange("add", location_id, name, coordinates, added=neighbors))
+
+    def update_location(self, location_id: int, name: str, coordinates: Tuple[float, float],
+                        added: Optional[Dict[int, float]] = None, removed=()):
+        """
+        added must re-measure every remaining edge if the location moved
+        """
+        self.apply(GraphChange("update", location_id, name, coordinates, added=added, removed=removed))
+
+    def remove_location(self, location_id: int):
+        self.apply(GraphChange("remove", location_id))
+
+
+graph_cache = GraphCache()
+
+
+class ShortestPathTree:
+    """
+    Result of a one-to-all search as parallel arrays in the order locations
+    were settled: index positions, distances and the position each was
+    reached from (-1 for a source). That is 16 bytes per location where a
+    pair of dicts costs a couple of hundred.
+    """
+
+    def __init__(self, ids: array, order: array, distances: array, parents: array):
+        # The CSR ids array, shared with the graph; positions stay valid
+        self._ids = ids
+        self.order = order
+        self.distances = distances
+        self.parents = parents
+
+    def __len__(self) -> int:
+        return len(self.order)
+
+    def __iter__(self) -> Iterator[Tuple[int, Optional[int], float]]:
+        """
+        Yields (location_id, previous_id, distance), nearest first
+        """
+        ids = self._ids
+        for position, parent, distance in zip(self.order, self.parents, self.distances):
+            yield ids[position], (ids[parent] if parent >= 0 else None), distance
+
+    def memory_bytes(self) -> int:
+        return len(self.order) * (self.order.itemsize + self.distances.itemsize + self.parents.itemsize)
+
+
+class ShortestPathTreeCache:
+    """
+    LRU cache of one-to-all shortest-path trees keyed by start location,
+    cleared whenever graph_cache changes. The budget is the total number of
+    locations over all cached trees, since every tree covers the whole
+    reachable graph and so grows with it.
+    """
+
+    def __init__(self, graph_cache, max_nodes: int = 4_000_000):
+        self._graph_cache = graph_cache
+        self._trees = OrderedDict()
+        self._lock = threading.Lock()
+        self._nodes = 0
+        self.max_nodes = max_nodes
+        graph_cache.add_listener(self.clear)
+
+    def get(self, db, start_id: int) -> ShortestPathTree:
+        version = self._graph_cache.version
+        with self._lock:
+            entry = self._trees.get(start_id)
+            if entry is not None and entry[0] == version:
+                self._trees.move_to_end(start_id)
+                return entry[1]
+
+        tree = self._graph_cache.get(db).settled_tree(start_id)
+        with self._lock:
+            if self._graph_cache.version == version and len(tree) <= self.max_nodes:
+                old = self._trees.pop(start_id, None)
+                if old is not None:
+                    self._nodes -= len(old[1])
+                self._trees[start_id] = (version, tree)
+                self._nodes += len(tree)
+                while self._nodes > self.max_nodes:
+                    _, (_, evicted) = self._trees.popitem(last=False)
+                    self._nodes -= len(evicted)
+        return tree
+
+    def clear(self, change: Optional[GraphChange] = None):
+        with self._lock:
+            self._trees.clear()
+            self._nodes = 0
+
+
+tree_cache = ShortestPathTreeCache(graph_cache)
@@ -0,0 +1,59 @@
+# hashing.py
+import asyncio
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from metrics import metrics
+from security import pwd_context
+
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "4"))
+# Requests allowed to wait for a worker before new ones are turned away
+PASSWORD_HASH_MAX_QUEUE = int(os.getenv("PASSWORD_HASH_MAX_QUEUE", "64"))
+
+
+class PasswordPoolOverloaded(Exception):
+    pass
+
+
+class PasswordWorkerPool:
+    """
+    Runs bcrypt hashing and verification on a bounded thread pool so it never
+    blocks the event loop. bcrypt releases the GIL while it works, so threads
+    give real parallelism. Once workers plus queue are full, new work is
+    rejected with PasswordPoolOverloaded instead of piling up.
+    """
+
+    def __init__(self, max_workers: int = PASSWORD_HASH_WORKERS, max_queue: int = PASSWORD_HASH_MAX_QUEUE):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="bcrypt")
+        self._capacity = max_workers + max_queue
+        self._pending = 0
+        self._lock = threading.Lock()
+        metrics.gauge("password_pool_pending", lambda: self._pending)
+
+    def _submit(self, fn, *args) -> Future:
+        with self._lock:
+            if self._pending >= self._capacity:
+                metrics.increment("password_pool_rejected")
+                raise PasswordPoolOverloaded()
+            self._pending += 1
+        future = self._executor.submit(fn, *args)
+        future.add_done_callback(self._done)
+        return future
+
+    def _done(self, _):
+        with self._lock:
+            self._pending -= 1
+
+    async def hash(self, password: str) -> str:
+        return await asyncio.wrap_future(self._submit(pwd_context.hash, password))
+
+    async def verify(self, password: str, hashed_password: str) -> bool:
+        return await asyncio.wrap_future(self._submit(pwd_context.verify, password, hashed_password))
+
+    def hash_sync(self, password: str) -> str:
+        # For sync endpoints, which already run on a threadpool thread
+        return self._submit(pwd_context.hash, password).result()
+
+
+password_pool = PasswordWorkerPool()
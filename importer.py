@@ -0,0 +1,287 @@
+# importer.py
+"""
+Bulk import of locations and edges from a GeoJSON FeatureCollection or CSV.
+
+Rows are validated one at a time as they are read, CSV through csv.DictReader
+and GeoJSON through ijson's incremental parser, so the upload itself is never
+held in memory as a whole. Everything is then written in a single transaction
+with multi-row INSERTs, and edge distances are computed for all edges at once
+with NumPy.
+
+    python importer.py campus.geojson
+    python importer.py rooms.csv --edges corridors.csv
+
+GeoJSON features need a Point geometry; their properties hold ref, name,
+category and the optional location fields, plus connected_to (a list of
+refs). CSV files use the columns ref, name, category, lon, lat, description,
+building, floor, room_number and connected_to (refs separated by ";"). An
+edges CSV has the columns from_ref and to_ref. A ref that is not defined in
+the import is read as the id of an existing location.
+"""
+import codecs
+import csv
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import ijson
+import numpy as np
+from pydantic import ValidationError
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+
+import models, schemas
+from cache_sync import LOCATIONS, cache_versions
+from floors import climb_cost, edge_kind
+from geo import haversine_distances
+from graph import graph_cache
+from response_cache import response_cache
+from search import search_index
+from wkb import point_from_wkb
+
+# Rows per INSERT statement
+BATCH_SIZE = 1000
+# Stop collecting validation errors after this many
+MAX_ERRORS = 100
+
+Row = Tuple[int, dict]
+
+
+class ImportValidationError(ValueError):
+    def __init__(self, errors: List[str]):
+        super().__init__(f"{len(errors)} invalid rows")
+        self.errors = errors
+
+
+def iter_geojson_rows(fp) -> Iterator[Row]:
+    """
+    Rows of a GeoJSON FeatureCollection read from a binary file. Features are
+    built one at a time from the parser's events, so only the current one is
+    held in memory.
+    """
+    collection_type = None
+    builder = None
+    number = 0
+    try:
+        for prefix, event, value in ijson.parse(_skip_bom(fp), use_float=True):
+            if builder is not None:
+                builder.event(event, value)
+                if prefix == "features.item" and event == "end_map":
+                    number += 1
+                    yield number, _feature_row(builder.value)
+                    builder = None
+            elif prefix == "features.item" and event == "start_map":
+                builder = ijson.ObjectBuilder()
+                builder.event(event, value)
+            elif prefix == "type":
+                collection_type = value
+                if collection_type != "FeatureCollection":
+                    break
+    except ijson.JSONError as e:
+        raise ValueError(f"invalid JSON: {e}") from e
+    # "type" may follow the features, so this can only be checked at the end
+    if collection_type != "FeatureCollection":
+        raise ImportValidationError(["expected a GeoJSON FeatureCollection"])
+
+
+def _feature_row(feature) -> dict:
+    if not isinstance(feature, dict):
+        return {}
+    geometry = feature.get("geometry") or {}
+    row = dict(feature.get("properties") or {})
+    if geometry.get("type") == "Point" and len(geometry.get("coordinates", [])) >= 2:
+        row["lon"], row["lat"] = geometry["coordinates"][:2]
+    return row
+
+
+def _skip_bom(binary_fp):
+    # ijson reads bytes and rejects a UTF-8 byte order mark
+    start = binary_fp.tell()
+    if binary_fp.read(len(codecs.BOM_UTF8)) != codecs.BOM_UTF8:
+        binary_fp.seek(start)
+    return binary_fp
+
+
+def iter_csv_rows(fp) -> Iterator[Row]:
+    for number, row in enumerate(csv.DictReader(fp), 1):
+        row = {key: value for key, value in row.items() if value not in (None, "")}
+        row["connected_to"] = [ref for ref in row.get("connected_to", "").split(";") if ref]
+        yield number, row
+
+
+def iter_edge_rows(fp) -> Iterator[Tuple[int, str, str]]:
+    for number, row in enumerate(csv.DictReader(fp), 1):
+        yield number, (row.get("from_ref") or "").strip(), (row.get("to_ref") or "").strip()
+
+
+def text_stream(binary_fp):
+    # Decode an uploaded file lazily instead of reading it into memory
+    return codecs.getreader("utf-8-sig")(binary_fp)
+
+
+def _validate(rows: Iterable[Row], edge_rows: Iterable[Tuple[int, str, str]]):
+    locations: Dict[str, schemas.LocationImport] = {}
+    pairs = []
+    errors = []
+    for number, row in rows:
+        try:
+            location = schemas.LocationImport(**row)
+        except ValidationError as e:
+            errors.append(f"row {number}: {e.errors()}")
+        else:
+            if location.ref in locations:
+                errors.append(f"row {number}: duplicate ref {location.ref!r}")
+            locations[location.ref] = location
+            pairs.extend((location.ref, ref) for ref in location.connected_to)
+        if len(errors) >= MAX_ERRORS:
+            return locations, pairs, errors
+    for number, from_ref, to_ref in edge_rows:
+        if not from_ref or not to_ref:
+            errors.append(f"edge row {number}: from_ref and to_ref are required")
+        else:
+            pairs.append((from_ref, to_ref))
+        if len(errors) >= MAX_ERRORS:
+            break
+    return locations, pairs, errors
+
+
+def _batches(items: List[dict]):
+    iterator = iter(items)
+    while True:
+        batch = list(islice(iterator, BATCH_SIZE))
+        if not batch:
+            return
+        yield batch
+
+
+def import_locations(db: Session, rows: Iterable[Row],
+                     edge_rows: Optional[Iterable[Tuple[int, str, str]]] = None) -> schemas.ImportResult:
+    locations, pairs, errors = _validate(rows, edge_rows or ())
+    if errors:
+        raise ImportValidationError(errors)
+
+    # Reserve a block of ids. FOR UPDATE locks the end of the id index, so
+    # concurrent inserts wait until this transaction commits.
+    next_id = db.execute(
+        select(func.coalesce(func.max(models.Location.id), 0)).with_for_update()
+    ).scalar()
+    ids = {}
+    coordinates = {}
+    floors = {}
+    for ref, location in locations.items():
+        next_id += 1
+        ids[ref] = next_id
+        coordinates[next_id] = (location.lon, location.lat)
+        floors[next_id] = location.floor
+
+    # Resolve edge refs; anything outside the import must be an existing location
+    edges = set()
+    existing_ids = set()
+    for from_ref, to_ref in pairs:
+        resolved = []
+        for ref in (from_ref, to_ref):
+            if ref in ids:
+                resolved.append(ids[ref])
+            elif ref.isdigit():
+                resolved.append(int(ref))
+                existing_ids.add(int(ref))
+            else:
+                errors.append(f"edge {from_ref!r}-{to_ref!r}: unknown ref {ref!r}")
+        if len(resolved) == 2 and resolved[0] != resolved[1]:
+            if resolved[0] in existing_ids and resolved[1] in existing_ids:
+                errors.append(f"edge {from_ref!r}-{to_ref!r}: at least one end must be an imported location")
+            edges.add((min(resolved), max(resolved)))
+    if existing_ids:
+        rows_found = db.execute(
+            select(models.Location.id, models.Location.floor, func.ST_AsBinary(models.Location.coordinates))
+            .where(models.Location.id.in_(existing_ids))
+        )
+        for location_id, floor, wkb in rows_found:
+            coordinates[location_id] = point_from_wkb(wkb)
+            floors[location_id] = floor
+        errors.extend(f"unknown location id {location_id}" for location_id in existing_ids - coordinates.keys())
+    if errors:
+        db.rollback()
+        raise ImportValidationError(errors[:MAX_ERRORS])
+
+    location_rows = [
+        {
+            "id": ids[ref],
+            "name": location.name,
+            "description": location.description,
+            "building": location.building,
+            "floor": location.floor,
+            "room_number": location.room_number,
+            "category": location.category,
+            "coordinates": f"SRID=4326;POINT({location.lon} {location.lat})",
+        }
+        for ref, location in locations.items()
+    ]
+
+    edge_list = sorted(edges)
+    edge_rows_out = []
+    if edge_list:
+        ends = np.array(
+            [coordinates[from_id] + coordinates[to_id] for from_id, to_id in edge_list], dtype=float
+        )
+        distances = haversine_distances(ends[:, 0], ends[:, 1], ends[:, 2], ends[:, 3])
+        for (from_id, to_id), distance in zip(edge_list, distances.tolist()):
+            # Edges between floors are taken to be stairs
+            kind = edge_kind(floors[from_id], floors[to_id])
+            distance += climb_cost(kind, floors[from_id], floors[to_id])
+            # Edges are stored in both directions, like create_location does
+            edge_rows_out.append({"from_id": from_id, "to_id": to_id, "distance": distance, "kind": kind})
+            edge_rows_out.append({"from_id": to_id, "to_id": from_id, "distance": distance, "kind": kind})
+
+    try:
+        # executemany; the MySQL driver rewrites each batch into one multi-row VALUES
+        for batch in _batches(location_rows):
+            db.execute(models.Location.__table__.insert(), batch)
+        for batch in _batches(edge_rows_out):
+            db.execute(models.path_edges.insert(), batch)
+        cache_versions.bump(db, LOCATIONS)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+    graph_cache.invalidate()
+    search_index.invalidate()
+    response_cache.invalidate("locations")
+    return schemas.ImportResult(locations=len(location_rows), edges=len(edge_list))
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    from database import SessionLocal
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("locations", help="GeoJSON FeatureCollection (.geojson/.json) or CSV file")
+    parser.add_argument("--edges", help="optional CSV file with from_ref,to_ref columns")
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    db = SessionLocal()
+    try:
+        is_geojson = args.locations.lower().endswith((".geojson", ".json"))
+        if is_geojson:
+            locations_file = open(args.locations, "rb")
+        else:
+            locations_file = open(args.locations, encoding="utf-8-sig", newline="")
+        with locations_file:
+            rows = iter_geojson_rows(locations_file) if is_geojson else iter_csv_rows(locations_file)
+            edges_file = open(args.edges, encoding="utf-8-sig", newline="") if args.edges else None
+            try:
+                result = import_locations(db, rows, iter_edge_rows(edges_file) if edges_file else None)
+            finally:
+                if edges_file:
+                    edges_file.close()
+    except ImportValidationError as e:
+        for error in e.errors:
+            print(error)
+        raise SystemExit(1)
+    finally:
+        db.close()
+    print(f"Imported {result.locations} locations and {result.edges} edges "
+          f"in {time.perf_counter() - started:.2f}s")
@@ -1,13 +1,27 @@
-from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi import FastAPI, Depends, File, HTTPException, Query, Request, Response, UploadFile, status
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
 from typing import List, Optional
 from datetime import datetime, timedelta
-import models, schemas, crud
-from database import engine, get_db
+import json
+import models, schemas, crud, crud_async, importer
+from cache_sync import EMERGENCY, LOCATIONS, OCCUPANCY, POI, cache_versions
+from ch import hierarchy_cache
+from database import SessionLocal, engine, get_db, get_async_db
+from hashing import PasswordPoolOverloaded, password_pool
+from metrics import metrics
+from occupancy import occupancy_buffer
+from poi_stream import poi_broadcaster
+from pydantic import parse_obj_as
+from response_cache import response_cache
+from routing_costs import routing_costs
+from user_cache import user_cache
 import jwt
-from passlib.context import CryptContext
 from schemas import UserCreate  # make sure you have this Pydantic schema
 from models import User  # assuming you have a User model
 from sqlalchemy.orm import Session
@@ -25,20 +39,52 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],  # Allow all methods (GET, POST, PUT, DELETE, etc.)
     allow_headers=["*"],  # Allow all headers
+    expose_headers=["X-Next-Cursor", "ETag"],  # Keyset pagination cursor for /locations/, cache validator
 )
 # Authentication setup
 SECRET_KEY = "your-secret-key"  # Change this in production!
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
+@app.exception_handler(PasswordPoolOverloaded)
+async def password_pool_overloaded_handler(request, exc):
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": "Too many concurrent sign-ins, please retry shortly"},
+        headers={"Retry-After": "1"},
+    )
+
+occupancy_buffer.add_listener(crud.publish_poi_changes)
+occupancy_buffer.add_listener(routing_costs.refresh_pois)
+# Other workers' writes, so this process's caches don't keep serving old data
+cache_versions.add_listener(LOCATIONS, crud.forget_locations)
+cache_versions.add_listener(POI, crud.forget_pois)
+cache_versions.add_listener(OCCUPANCY, crud.forget_occupancy)
+cache_versions.add_listener(EMERGENCY, crud.forget_emergency_services)
+
+@app.on_event("startup")
+def start_cache_sync():
+    cache_versions.start()
+
+@app.on_event("startup")
+def load_hierarchy():
+    # Pick up the hierarchy saved by `python ch.py` before the first "ch" query
+    hierarchy_cache.warm(SessionLocal)
+
+@app.on_event("shutdown")
+def flush_occupancy():
+    # Don't lose the readings buffered since the last timed flush
+    occupancy_buffer.flush()
+
 # Authentication endpoints
 @app.post("/token", response_model=schemas.Token)
 async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-    user = crud.authenticate_user(db, form_data.username, form_data.password, pwd_context)
-    if not user:
+    # The lookup runs in the threadpool and bcrypt on the password worker
+    # pool, so neither blocks the event loop
+    user = await run_in_threadpool(crud.get_user_by_username, db, form_data.username)
+    if not user or not await password_pool.verify(form_data.password, user.hashed_password):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
@@ -84,9 +130,14 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = De
     except jwt.PyJWTError:
         raise credentials_exception
         
-    user = crud.get_user_by_username(db, username=token_data.username)
+    # Resolved users are cached per subject so most requests skip the database
+    user = user_cache.get(token_data.username)
     if user is None:
-        raise credentials_exception
+        db_user = crud.get_user_by_username(db, username=token_data.username)
+        if db_user is None or not db_user.is_active:
+            raise credentials_exception
+        user = schemas.User.from_orm(db_user)
+        user_cache.put(token_data.username, user)
     return user
 
 async def get_admin_user(current_user = Depends(get_current_user)):
@@ -97,11 +148,55 @@ async def get_admin_user(current_user = Depends(get_current_user)):
         )
     return current_user
 
+# Read-only collection responses are cached as encoded JSON until a crud
+# write invalidates them, and revalidated with ETag/If-None-Match
+async def cached_collection(request: Request, namespace: str, key: tuple, model, load, headers=None):
+    entry = response_cache.get(namespace, key)
+    if entry is None:
+        generation = response_cache.generation(namespace)
+        items = await load()
+        content = jsonable_encoder(parse_obj_as(List[model], items))
+        entry = response_cache.put(namespace, key, content, generation, headers(items) if headers else None)
+    if entry.matches(request.headers.get("if-none-match")):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=entry.headers)
+    return Response(content=entry.body, media_type="application/json", headers=entry.headers)
+
 # Location endpoints
+def next_cursor_header(limit: int):
+    # A full page means there may be more; pass the last id back as ?after_id=
+    def headers(locations):
+        return {"X-Next-Cursor": str(locations[-1]['id'])} if locations and len(locations) == limit else None
+    return headers
+
 @app.get("/locations/", response_model=List[schemas.Location])
-def read_locations(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    locations = crud.get_locations(db, skip=skip, limit=limit)
-    return locations
+async def read_locations(request: Request, skip: int = 0, limit: int = 100, after_id: Optional[int] = None, db: AsyncSession = Depends(get_async_db)):
+    return await cached_collection(
+        request, "locations", (skip, limit, after_id), schemas.Location,
+        lambda: crud_async.get_locations(db, skip=skip, limit=limit, after_id=after_id),
+        headers=next_cursor_header(limit)
+    )
+
+@app.get("/locations/stream")
+def stream_locations(after_id: Optional[int] = None, limit: Optional[int] = Query(None, ge=1)):
+    # One JSON object per line, written as rows are read from the database.
+    # The body streams after yield dependencies are torn down, so the
+    # generator opens and closes its own session instead of using get_db.
+    def lines():
+        db = SessionLocal()
+        try:
+            for location in crud.iter_locations(db, after_id=after_id, limit=limit):
+                yield json.dumps(location) + "\n"
+        finally:
+            db.close()
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+@app.get("/locations/search", response_model=List[schemas.Location])
+def search_locations(q: str, limit: int = Query(10, ge=1, le=50), db: Session = Depends(get_db)):
+    return crud.search_locations(db, q=q, limit=limit)
+
+@app.get("/locations/nearest", response_model=List[schemas.NearestLocation])
+def read_nearest_locations(lon: float = Query(..., ge=-180, le=180), lat: float = Query(..., ge=-90, le=90), k: int = Query(1, ge=1, le=100), db: Session = Depends(get_db)):
+    return crud.get_nearest_locations(db, lon=lon, lat=lat, k=k)
 
 @app.get("/locations/{location_id}", response_model=schemas.Location)
 def read_location(location_id: int, db: Session = Depends(get_db)):
@@ -114,6 +209,21 @@ def read_location(location_id: int, db: Session = Depends(get_db)):
 def create_location(location: schemas.LocationCreate, db: Session = Depends(get_db), current_user = Depends(get_admin_user)):
     return crud.create_location(db=db, location=location)
 
+@app.post("/locations/import", response_model=schemas.ImportResult)
+def import_locations(locations: UploadFile = File(...), edges: Optional[UploadFile] = File(None), db: Session = Depends(get_db), current_user = Depends(get_admin_user)):
+    # GeoJSON FeatureCollection or CSV, plus an optional from_ref,to_ref edges CSV
+    if (locations.filename or "").lower().endswith((".geojson", ".json")) or "json" in (locations.content_type or ""):
+        rows = importer.iter_geojson_rows(locations.file)
+    else:
+        rows = importer.iter_csv_rows(importer.text_stream(locations.file))
+    edge_rows = importer.iter_edge_rows(importer.text_stream(edges.file)) if edges else None
+    try:
+        return importer.import_locations(db, rows, edge_rows)
+    except importer.ImportValidationError as e:
+        raise HTTPException(status_code=422, detail=e.errors)
+    except (ValueError, UnicodeDecodeError) as e:
+        raise HTTPException(status_code=400, detail=f"Could not parse import file: {e}")
+
 @app.put("/locations/{location_id}", response_model=schemas.Location)
 def update_location(location_id: int, location: schemas.LocationUpdate, db: Session = Depends(get_db), current_user = Depends(get_admin_user)):
     db_location = crud.get_location(db, location_id=location_id)
@@ -130,22 +240,78 @@ def delete_location(location_id: int, db: Session = Depends(get_db), current_use
     return {"message": "Location deleted successfully"}
 
 # Pathfinding endpoint
+# Sync on purpose: the search is CPU-bound, so it runs on the threadpool instead of blocking the event loop
 @app.get("/path/", response_model=schemas.Path)
-def find_path(start_id: int, end_id: int, db: Session = Depends(get_db)):
-    path = crud.calculate_path(db, start_id=start_id, end_id=end_id)
+def find_path(start_id: Optional[int] = None, end_id: Optional[int] = None,
+              start_lon: Optional[float] = None, start_lat: Optional[float] = None,
+              end_lon: Optional[float] = None, end_lat: Optional[float] = None,
+              algorithm: str = Query("astar", regex="^(ch|astar|dijkstra|bidirectional|bidirectional_astar|layered)$"),
+              avoid_crowds: bool = False, step_free: bool = False, db: Session = Depends(get_db)):
+    # Raw coordinates (e.g. a phone GPS fix) snap to the nearest graph node
+    if start_id is None and start_lon is not None and start_lat is not None:
+        start_id = crud.snap_to_location(db, lon=start_lon, lat=start_lat)
+    if end_id is None and end_lon is not None and end_lat is not None:
+        end_id = crud.snap_to_location(db, lon=end_lon, lat=end_lat)
+    if start_id is None or end_id is None:
+        raise HTTPException(status_code=400, detail="Provide start_id/end_id or start_lon/start_lat and end_lon/end_lat")
+    path = crud.calculate_path(db, start_id=start_id, end_id=end_id, algorithm=algorithm,
+                               avoid_crowds=avoid_crowds, step_free=step_free)
     if not path:
         raise HTTPException(status_code=404, detail="Path could not be calculated")
     return path
 
+@app.post("/path/matrix", response_model=schemas.DistanceMatrix)
+def find_distance_matrix(request: schemas.DistanceMatrixRequest, db: Session = Depends(get_db)):
+    return crud.calculate_distance_matrix(db, sources=request.sources, targets=request.targets)
+
+@app.get("/path/tree")
+def find_shortest_path_tree(start_id: int, db: Session = Depends(get_db)):
+    tree = crud.calculate_shortest_path_tree(db, start_id=start_id)
+    if tree is None:
+        raise HTTPException(status_code=404, detail="Location not found")
+    # One JSON object per line, nearest location first
+    lines = (json.dumps(entry) + "\n" for entry in tree)
+    return StreamingResponse(lines, media_type="application/x-ndjson")
+
 # POI endpoints
 @app.get("/poi/", response_model=List[schemas.POI])
-def read_pois(type: Optional[str] = None, skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    return crud.get_pois(db, type=type, skip=skip, limit=limit)
+async def read_pois(request: Request, type: Optional[str] = None, skip: int = 0, limit: int = 100, db: AsyncSession = Depends(get_async_db)):
+    return await cached_collection(
+        request, "poi", (type, skip, limit), schemas.POI,
+        lambda: crud_async.get_pois(db, type=type, skip=skip, limit=limit)
+    )
+
+@app.get("/poi/stream")
+async def stream_pois(request: Request, type: Optional[List[str]] = Query(None)):
+    # Server-Sent Events: "poi" events carry {"type", "changes": [{"id", changed fields}]},
+    # "resync" asks the client to re-fetch /poi/
+    return StreamingResponse(
+        poi_broadcaster.stream(request, type),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.post("/poi/occupancy", response_model=schemas.OccupancyAccepted, status_code=status.HTTP_202_ACCEPTED)
+async def ingest_occupancy(updates: List[schemas.OccupancyUpdate], current_user = Depends(get_admin_user)):
+    # Buffered and written in batches; /poi/ reflects them after the next flush
+    for update in updates:
+        occupancy_buffer.record(update.poi_id, update.current_occupancy, update.delta, update.is_available)
+    return {"accepted": len(updates)}
 
 # Emergency services endpoints
 @app.get("/emergency/", response_model=List[schemas.EmergencyService])
-def read_emergency_services(type: Optional[str] = None, skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
-    return crud.get_emergency_services(db, type=type, skip=skip, limit=limit)
+async def read_emergency_services(request: Request, type: Optional[str] = None, skip: int = 0, limit: int = 100, db: AsyncSession = Depends(get_async_db)):
+    return await cached_collection(
+        request, "emergency", (type, skip, limit), schemas.EmergencyService,
+        lambda: crud_async.get_emergency_services(db, type=type, skip=skip, limit=limit)
+    )
+
+@app.get("/emergency/nearest", response_model=schemas.EmergencyRoute)
+def find_nearest_emergency_service(location_id: int, type: str = Query(..., regex="^(fire_extinguisher|first_aid|emergency_exit)$"), db: Session = Depends(get_db)):
+    route = crud.find_nearest_emergency_service(db, location_id=location_id, type=type)
+    if route is None:
+        raise HTTPException(status_code=404, detail="No reachable emergency service found")
+    return route
 
 @app.post("/users/", response_model=schemas.User)
 def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
@@ -163,15 +329,28 @@ def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
             raise HTTPException(status_code=400, detail="Username already registered")
         
         # Hash the password here before passing to create_user
-        hashed_password = pwd_context.hash(user.password)
+        hashed_password = password_pool.hash_sync(user.password)
         
         # Modified to NOT pass pwd_context
         return crud.create_user(db=db, user=user, hashed_password=hashed_password)
+    except (HTTPException, PasswordPoolOverloaded):
+        raise
     except Exception as e:
         # Log the actual error
         print(f"Error creating user: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Internal server error: {str(e)}")
 
+@app.put("/users/{user_id}", response_model=schemas.User)
+def update_user(user_id: int, user: schemas.UserUpdate, db: Session = Depends(get_db), current_user = Depends(get_admin_user)):
+    db_user = crud.get_user(db, user_id=user_id)
+    if db_user is None:
+        raise HTTPException(status_code=404, detail="User not found")
+    return crud.update_user(db=db, user_id=user_id, user=user)
+
+@app.get("/metrics")
+def read_metrics(current_user = Depends(get_admin_user)):
+    return metrics.snapshot()
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
@@ -0,0 +1,32 @@
+# metrics.py
+import threading
+from typing import Callable, Dict
+
+
+class Metrics:
+    """
+    Minimal in-process metrics registry: named counters plus gauges that are
+    read from a callback when a snapshot is taken
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[str, float] = {}
+        self._gauges: Dict[str, Callable[[], float]] = {}
+
+    def increment(self, name: str, value: float = 1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def gauge(self, name: str, callback: Callable[[], float]):
+        self._gauges[name] = callback
+
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            values = dict(self._counters)
+        for name, callback in self._gauges.items():
+            values[name] = callback()
+        return values
+
+
+metrics = Metrics()
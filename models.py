@@ -1,4 +1,4 @@
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, Float, Text, Table
+from sqlalchemy import BigInteger, Boolean, Column, ForeignKey, Index, Integer, String, Float, Text, Table
 from sqlalchemy.orm import relationship
 from geoalchemy2 import Geometry
 from database import Base
@@ -7,7 +7,16 @@ from database import Base
 path_edges = Table('path_edges', Base.metadata,
     Column('from_id', Integer, ForeignKey('locations.id'), primary_key=True),
     Column('to_id', Integer, ForeignKey('locations.id'), primary_key=True),
-    Column('distance', Float)
+    Column('distance', Float),
+    # walk, or how the edge changes floors: stairs, elevator, ramp, escalator
+    Column('kind', String(20), nullable=False, default='walk', server_default='walk')
+)
+
+# One row per group of cached data (see cache_sync.py). Writes bump it in their
+# own transaction so other worker processes know to drop their copies.
+cache_versions = Table('cache_versions', Base.metadata,
+    Column('name', String(32), primary_key=True),
+    Column('version', BigInteger, nullable=False, default=0)
 )
 
 class User(Base):
@@ -32,7 +41,8 @@ class Location(Base):
     category = Column(String(50), index=True)
     
     # Change this line to specify SRID 4326 explicitly
-    coordinates = Column(Geometry("POINT", srid=4326))
+    # MySQL only allows a SPATIAL INDEX on NOT NULL columns with a fixed SRID
+    coordinates = Column(Geometry("POINT", srid=4326, spatial_index=True), nullable=False)
     
     # Relationships
     connected_to = relationship(
@@ -46,6 +56,9 @@ class Location(Base):
     pois = relationship("POI", back_populates="location")
     emergency_services = relationship("EmergencyService", back_populates="location")
 
+    # Per-floor graph layers are loaded by (building, floor)
+    __table_args__ = (Index("ix_locations_building_floor", "building", "floor"),)
+
 class POI(Base):
     __tablename__ = "points_of_interest"
 
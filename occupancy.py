@@ -0,0 +1,200 @@
+# occupancy.py
+import os
+import threading
+from typing import Dict, Optional
+
+from sqlalchemy import bindparam, case, func
+
+import models
+from cache_sync import OCCUPANCY, cache_versions
+from metrics import metrics
+from response_cache import response_cache
+
+# Seconds between flushes of buffered readings to the database
+OCCUPANCY_FLUSH_INTERVAL = float(os.getenv("OCCUPANCY_FLUSH_INTERVAL", "1.0"))
+# Flush early once this many POIs have pending readings
+OCCUPANCY_MAX_PENDING = int(os.getenv("OCCUPANCY_MAX_PENDING", "5000"))
+# Rows per executemany batch
+BATCH_SIZE = 1000
+
+
+class _Pending:
+    # Coalesced readings for one POI. occupancy is an absolute count when a
+    # sensor sent one; otherwise delta accumulates relative changes. The
+    # buffer does not know capacities, so the UPDATEs clamp to them.
+    __slots__ = ("occupancy", "delta", "is_available")
+
+    def __init__(self):
+        self.occupancy: Optional[int] = None
+        self.delta = 0
+        self.is_available: Optional[bool] = None
+
+    def add(self, occupancy: Optional[int] = None, delta: Optional[int] = None,
+            is_available: Optional[bool] = None):
+        if occupancy is not None:
+            self.occupancy = occupancy
+            self.delta = 0
+        elif delta:
+            if self.occupancy is not None:
+                self.occupancy = max(0, self.occupancy + delta)
+            else:
+                self.delta += delta
+        if is_available is not None:
+            self.is_available = is_available
+
+    def merge_older(self, older: "_Pending"):
+        # Put back readings from a failed flush underneath newer ones
+        if self.occupancy is None:
+            if older.occupancy is not None:
+                self.occupancy = max(0, older.occupancy + self.delta)
+                self.delta = 0
+            else:
+                self.delta += older.delta
+        if self.is_available is None:
+            self.is_available = older.is_available
+
+
+def _column(column):
+    return models.POI.__table__.c[column]
+
+
+def _clamped(occupancy):
+    # Keep a stored count within [0, capacity]; a POI without a capacity has no upper bound
+    occupancy = func.greatest(0, occupancy)
+    return case((_column("capacity").is_(None), occupancy), else_=func.least(_column("capacity"), occupancy))
+
+
+# One statement per kind of change, each run as an executemany. Both clamp,
+# since a coalesced absolute reading may carry later deltas on top of it.
+_SET_OCCUPANCY = models.POI.__table__.update().where(
+    _column("id") == bindparam("b_id")
+).values(current_occupancy=_clamped(bindparam("b_occupancy")))
+
+_ADD_OCCUPANCY = models.POI.__table__.update().where(
+    _column("id") == bindparam("b_id")
+).values(current_occupancy=_clamped(func.coalesce(_column("current_occupancy"), 0) + bindparam("b_delta")))
+
+_SET_AVAILABLE = models.POI.__table__.update().where(
+    _column("id") == bindparam("b_id")
+).values(is_available=bindparam("b_available"))
+
+
+class OccupancyBuffer:
+    """
+    Buffers POI occupancy readings in memory and writes them to the database
+    on a timer.
+
+    Repeated readings for the same POI between flushes are coalesced into one
+    row, and each flush is a single transaction of batched UPDATEs, so the
+    database sees at most one write per POI per interval however often the
+    sensors report. Readings for unknown POI ids update no rows.
+    """
+
+    def __init__(self, session_factory=None, interval: float = OCCUPANCY_FLUSH_INTERVAL,
+                 max_pending: int = OCCUPANCY_MAX_PENDING):
+        self._session_factory = session_factory
+        self.interval = interval
+        self.max_pending = max_pending
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending: Dict[int, _Pending] = {}
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._listeners = []
+        metrics.gauge("occupancy_pending", lambda: len(self._pending))
+
+    def add_listener(self, listener):
+        # Called as listener(db, poi_ids) after each committed flush
+        self._listeners.append(listener)
+
+    def record(self, poi_id: int, occupancy: Optional[int] = None, delta: Optional[int] = None,
+               is_available: Optional[bool] = None):
+        with self._lock:
+            entry = self._pending.get(poi_id)
+            if entry is None:
+                entry = self._pending[poi_id] = _Pending()
+            else:
+                metrics.increment("occupancy_readings_coalesced")
+            entry.add(occupancy, delta, is_available)
+            pending = len(self._pending)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="occupancy-flush", daemon=True)
+                self._thread.start()
+        metrics.increment("occupancy_readings")
+        if pending >= self.max_pending:
+            self._wake.set()
+
+    def _run(self):
+        while True:
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                # The readings were put back; try again on the next tick
+                print(f"Error flushing occupancy readings: {str(e)}")
+
+    def flush(self) -> int:
+        """
+        Writes all pending readings; returns how many POIs were updated
+        """
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return 0
+
+            absolute, relative, availability = [], [], []
+            for poi_id, entry in pending.items():
+                if entry.occupancy is not None:
+                    absolute.append({"b_id": poi_id, "b_occupancy": entry.occupancy})
+                elif entry.delta:
+                    relative.append({"b_id": poi_id, "b_delta": entry.delta})
+                if entry.is_available is not None:
+                    availability.append({"b_id": poi_id, "b_available": entry.is_available})
+
+            db = self._session()
+            try:
+                try:
+                    for statement, rows in ((_SET_OCCUPANCY, absolute), (_ADD_OCCUPANCY, relative),
+                                            (_SET_AVAILABLE, availability)):
+                        for start in range(0, len(rows), BATCH_SIZE):
+                            db.execute(statement, rows[start:start + BATCH_SIZE])
+                    cache_versions.bump(db, OCCUPANCY)
+                    db.commit()
+                except Exception:
+                    db.rollback()
+                    metrics.increment("occupancy_flush_errors")
+                    self._requeue(pending)
+                    raise
+
+                response_cache.invalidate("poi")
+                metrics.increment("occupancy_flushes")
+                metrics.increment("occupancy_rows_flushed", len(pending))
+                # The readings are committed now; a failing listener must not requeue them
+                for listener in self._listeners:
+                    try:
+                        listener(db, list(pending))
+                    except Exception as e:
+                        print(f"Error in occupancy listener: {str(e)}")
+            finally:
+                db.close()
+            return len(pending)
+
+    def _session(self):
+        if self._session_factory is None:
+            from database import SessionLocal
+            self._session_factory = SessionLocal
+        return self._session_factory()
+
+    def _requeue(self, failed: Dict[int, _Pending]):
+        with self._lock:
+            for poi_id, older in failed.items():
+                newer = self._pending.get(poi_id)
+                if newer is None:
+                    self._pending[poi_id] = older
+                else:
+                    newer.merge_older(older)
+
+
+occupancy_buffer = OccupancyBuffer()
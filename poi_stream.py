@@ -0,0 +1,133 @@
+# poi_stream.py
+import asyncio
+import json
+import threading
+from collections import defaultdict
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+from metrics import metrics
+
+# Messages a subscriber may fall behind by before it is told to resync
+SUBSCRIBER_QUEUE_SIZE = 100
+# Seconds between keepalive comments on an idle stream
+KEEPALIVE_INTERVAL = 15.0
+
+# Sent to a subscriber that fell behind; the client re-fetches /poi/
+RESYNC_MESSAGE = "event: resync\ndata: {}\n\n"
+
+
+class _Subscriber:
+    __slots__ = ("types", "queue", "loop", "lagging")
+
+    def __init__(self, types: Optional[Set[str]], loop):
+        self.types = types
+        self.queue = asyncio.Queue(SUBSCRIBER_QUEUE_SIZE)
+        self.loop = loop
+        self.lagging = False
+
+    def offer(self, messages):
+        # Runs on the subscriber's event loop
+        if self.lagging:
+            return
+        for message in messages:
+            try:
+                self.queue.put_nowait(message)
+            except asyncio.QueueFull:
+                self.lagging = True
+                metrics.increment("poi_stream_resyncs")
+                return
+
+
+class POIBroadcaster:
+    """
+    Pushes POI occupancy and availability changes to Server-Sent Events
+    subscribers.
+
+    publish() is given the current (id, type, current_occupancy,
+    is_available) of changed POIs and compares them with what was last sent,
+    so clients receive only fields that actually changed. Each message holds
+    the diffs of one POI type and is encoded once, then shared by every
+    subscriber of that type.
+
+    Each worker process broadcasts the changes it writes itself.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscribers: Set[_Subscriber] = set()
+        # poi_id -> (current_occupancy, is_available) as last sent
+        self._sent: Dict[int, Tuple[Optional[int], Optional[bool]]] = {}
+        metrics.gauge("poi_stream_subscribers", lambda: len(self._subscribers))
+
+    @property
+    def has_subscribers(self) -> bool:
+        return bool(self._subscribers)
+
+    def publish(self, rows: Iterable[Tuple[int, str, Optional[int], Optional[bool]]]):
+        with self._lock:
+            if not self._subscribers:
+                # Nobody to diff against; the next subscriber starts from /poi/
+                self._sent.clear()
+                return
+            diffs = defaultdict(list)
+            for poi_id, poi_type, occupancy, available in rows:
+                previous = self._sent.get(poi_id)
+                diff = {"id": poi_id}
+                if previous is None or previous[0] != occupancy:
+                    diff["current_occupancy"] = occupancy
+                if previous is None or previous[1] != available:
+                    diff["is_available"] = available
+                if len(diff) > 1:
+                    diffs[poi_type].append(diff)
+                self._sent[poi_id] = (occupancy, available)
+            subscribers = list(self._subscribers)
+
+        if not diffs:
+            return
+        messages = {
+            poi_type: f"event: poi\ndata: {json.dumps({'type': poi_type, 'changes': changes}, separators=(',', ':'))}\n\n"
+            for poi_type, changes in diffs.items()
+        }
+        metrics.increment("poi_stream_messages", len(messages))
+        for subscriber in subscribers:
+            selected = [
+                message for poi_type, message in messages.items()
+                if subscriber.types is None or poi_type in subscriber.types
+            ]
+            if selected:
+                subscriber.loop.call_soon_threadsafe(subscriber.offer, selected)
+
+    def subscribe(self, types: Optional[Iterable[str]] = None) -> _Subscriber:
+        subscriber = _Subscriber(set(types) if types else None, asyncio.get_running_loop())
+        with self._lock:
+            self._subscribers.add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: _Subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    async def stream(self, request, types: Optional[Iterable[str]] = None):
+        """
+        Server-Sent Events body for one client
+        """
+        subscriber = self.subscribe(types)
+        try:
+            yield "retry: 3000\n\n"
+            while True:
+                try:
+                    message = await asyncio.wait_for(subscriber.queue.get(), KEEPALIVE_INTERVAL)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        return
+                    yield ": keepalive\n\n"
+                    continue
+                yield message
+                if subscriber.lagging and subscriber.queue.empty():
+                    subscriber.lagging = False
+                    yield RESYNC_MESSAGE
+        finally:
+            self.unsubscribe(subscriber)
+
+
+poi_broadcaster = POIBroadcaster()
@@ -0,0 +1,74 @@
+# recompute_edge_distances.py
+"""
+Rewrites every path_edges.distance in meters from the current location
+coordinates and floors. Edges written before distances were stored in meters
+hold planar degrees, and edges written before path_edges.kind existed have
+no notion of floors; run this once after upgrading. It adds the kind column
+if needed and marks existing edges between floors as stairs.
+
+    python recompute_edge_distances.py
+"""
+import numpy as np
+from sqlalchemy import bindparam, func, inspect, select, text
+
+import models
+from database import SessionLocal
+from floors import climb_cost, edge_kind
+from geo import haversine_distances
+from wkb import point_from_wkb
+
+BATCH_SIZE = 1000
+
+
+def add_kind_column(db):
+    columns = {column["name"] for column in inspect(db.get_bind()).get_columns("path_edges")}
+    if "kind" not in columns:
+        db.execute(text("ALTER TABLE path_edges ADD COLUMN kind VARCHAR(20) NOT NULL DEFAULT 'walk'"))
+
+
+def recompute_edge_distances(db) -> int:
+    add_kind_column(db)
+    locations = {
+        location_id: (point_from_wkb(wkb), floor)
+        for location_id, floor, wkb in db.execute(
+            select(models.Location.id, models.Location.floor, func.ST_AsBinary(models.Location.coordinates))
+        )
+    }
+    edges = [
+        (from_id, to_id, kind)
+        for from_id, to_id, kind in db.execute(
+            select(models.path_edges.c.from_id, models.path_edges.c.to_id, models.path_edges.c.kind)
+        )
+        if from_id in locations and to_id in locations
+    ]
+    if not edges:
+        return 0
+
+    ends = np.array([locations[from_id][0] + locations[to_id][0] for from_id, to_id, _ in edges], dtype=float)
+    distances = haversine_distances(ends[:, 0], ends[:, 1], ends[:, 2], ends[:, 3]).tolist()
+    statement = models.path_edges.update().where(
+        (models.path_edges.c.from_id == bindparam("b_from_id"))
+        & (models.path_edges.c.to_id == bindparam("b_to_id"))
+    ).values(distance=bindparam("b_distance"), kind=bindparam("b_kind"))
+    rows = []
+    for (from_id, to_id, kind), distance in zip(edges, distances):
+        from_floor, to_floor = locations[from_id][1], locations[to_id][1]
+        kind = edge_kind(from_floor, to_floor, None if kind == "walk" else kind)
+        rows.append({
+            "b_from_id": from_id,
+            "b_to_id": to_id,
+            "b_distance": distance + climb_cost(kind, from_floor, to_floor),
+            "b_kind": kind,
+        })
+    for start in range(0, len(rows), BATCH_SIZE):
+        db.execute(statement, rows[start:start + BATCH_SIZE])
+    db.commit()
+    return len(rows)
+
+
+if __name__ == "__main__":
+    db = SessionLocal()
+    try:
+        print(f"Updated {recompute_edge_distances(db)} edges")
+    finally:
+        db.close()
@@ -0,0 +1,81 @@
+# response_cache.py
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+from metrics import metrics
+
+RESPONSE_CACHE_MAX_ENTRIES = 1024
+
+
+class CachedResponse:
+    __slots__ = ("body", "etag", "headers")
+
+    def __init__(self, body: bytes, headers: Optional[Dict[str, str]] = None):
+        self.body = body
+        self.etag = '"' + hashlib.sha1(body).hexdigest()[:20] + '"'
+        self.headers = dict(headers or {}, ETag=self.etag)
+
+    def matches(self, if_none_match: Optional[str]) -> bool:
+        if not if_none_match:
+            return False
+        for tag in if_none_match.split(","):
+            tag = tag.strip()
+            if tag == "*" or tag.removeprefix("W/") == self.etag:
+                return True
+        return False
+
+
+class ResponseCache:
+    """
+    LRU cache of pre-encoded JSON response bodies for the read-only collection
+    endpoints, keyed by (namespace, query parameters).
+
+    crud writes call invalidate(namespace). Each namespace carries a
+    generation counter, so a body computed while a write was happening is
+    never stored.
+    """
+
+    def __init__(self, max_entries: int = RESPONSE_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple[str, tuple], CachedResponse]" = OrderedDict()
+        self._generations: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def generation(self, namespace: str) -> int:
+        return self._generations.get(namespace, 0)
+
+    def get(self, namespace: str, key: tuple) -> Optional[CachedResponse]:
+        with self._lock:
+            entry = self._entries.get((namespace, key))
+            if entry is not None:
+                self._entries.move_to_end((namespace, key))
+        metrics.increment("response_cache_hits" if entry is not None else "response_cache_misses")
+        return entry
+
+    def put(self, namespace: str, key: tuple, content, generation: int,
+            headers: Optional[Dict[str, str]] = None) -> CachedResponse:
+        """
+        Encodes content (already JSON-compatible) once and stores it unless
+        the namespace was invalidated since `generation` was read
+        """
+        entry = CachedResponse(json.dumps(content, separators=(",", ":")).encode(), headers)
+        with self._lock:
+            if self._generations.get(namespace, 0) == generation:
+                self._entries[(namespace, key)] = entry
+                self._entries.move_to_end((namespace, key))
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return entry
+
+    def invalidate(self, *namespaces: str):
+        with self._lock:
+            for namespace in namespaces:
+                self._generations[namespace] = self._generations.get(namespace, 0) + 1
+            for cache_key in [cache_key for cache_key in self._entries if cache_key[0] in namespaces]:
+                del self._entries[cache_key]
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,256 @@
+# routing_costs.py
+import threading
+from array import array
+from typing import Dict, List, Optional, Set, Tuple
+
+from floors import STEP_KINDS
+from graph import graph_cache
+
+# At full occupancy, walking past a POI costs this much extra per meter
+CROWD_PENALTY = 2.0
+# Occupancy ratio below which a POI does not count as crowded
+CROWD_THRESHOLD = 0.5
+
+
+class EdgeCosts:
+    """
+    Edge costs for one CSRGraph: weights is aligned with its targets array
+    and overlay mirrors its overlay, so searches read them in place of the
+    distances
+    """
+
+    def __init__(self, csr, weights: array, overlay: Dict[int, List[Tuple[int, float]]]):
+        self.csr = csr
+        self.weights = weights
+        self.overlay = overlay
+
+    def patched(self, positions, cost) -> "EdgeCosts":
+        """
+        A copy with every edge touching positions re-costed with cost. The
+        copy leaves searches running on this one undisturbed.
+        """
+        csr = self.csr
+        ids, offsets, targets, distances = csr.ids, csr.offsets, csr.targets, csr.weights
+        weights = array('d', self.weights)
+        overlay = dict(self.overlay)
+        # A node's own edges, and the reverse edges stored at its neighbours
+        touched = set(positions)
+        for position in positions:
+            touched.update(target for target, _ in csr.edges(position))
+        for position in touched:
+            from_id = ids[position]
+            edges = csr.overlay.get(position)
+            if edges is not None:
+                overlay[position] = [(target, cost(from_id, ids[target], distance)) for target, distance in edges]
+            elif position < csr.base_size:
+                for slot in range(offsets[position], offsets[position + 1]):
+                    weights[slot] = cost(from_id, ids[targets[slot]], distances[slot])
+        return EdgeCosts(csr, weights, overlay)
+
+
+def edge_cost_function(floors: Dict[int, int], crowding: Dict[int, float], elevators: Set[int],
+                       avoid_crowds: bool, step_free: bool,
+                       kinds: Optional[Dict[Tuple[int, int], str]] = None):
+    """
+    cost(from_id, to_id, distance) for the options. With avoid_crowds, an
+    edge costs its distance times the mean crowding multiplier of its two
+    ends. With step_free, edges of a stepped kind (stairs, escalators) cost
+    infinity; so does an untyped edge between different floors unless both
+    ends have a working elevator. Costs never drop below the distance, so the
+    A* heuristic stays admissible, and both directions of an edge cost the
+    same, so the bidirectional searches still apply.
+    """
+    multipliers = crowding if avoid_crowds else {}
+    kinds = kinds or {}
+    infinity = float('infinity')
+
+    def cost(from_id, to_id, distance):
+        if step_free:
+            kind = kinds.get((from_id, to_id))
+            if kind in STEP_KINDS:
+                return infinity
+            if kind is None:
+                from_floor = floors.get(from_id)
+                to_floor = floors.get(to_id)
+                if (from_floor is not None and to_floor is not None and from_floor != to_floor
+                        and not (from_id in elevators and to_id in elevators)):
+                    return infinity
+        return distance * (multipliers.get(from_id, 1.0) + multipliers.get(to_id, 1.0)) / 2
+    return cost
+
+
+def build_edge_costs(csr, floors: Dict[int, int], crowding: Dict[int, float],
+                     elevators: Set[int], avoid_crowds: bool, step_free: bool,
+                     kinds: Optional[Dict[Tuple[int, int], str]] = None) -> EdgeCosts:
+    """
+    Costs every edge of csr with edge_cost_function
+    """
+    cost = edge_cost_function(floors, crowding, elevators, avoid_crowds, step_free, kinds)
+    ids, offsets, targets = csr.ids, csr.offsets, csr.targets
+    weights = array('d', csr.weights)
+    for position in range(csr.base_size):
+        from_id = ids[position]
+        for slot in range(offsets[position], offsets[position + 1]):
+            weights[slot] = cost(from_id, ids[targets[slot]], weights[slot])
+    overlay = {
+        position: [(target, cost(ids[position], ids[target], distance)) for target, distance in edges]
+        for position, edges in list(csr.overlay.items())
+    }
+    return EdgeCosts(csr, weights, overlay)
+
+
+def poi_inputs(rows) -> Tuple[Dict[int, float], Set[int]]:
+    """
+    (crowding multiplier by location, locations with a working elevator) from
+    (location_id, type, capacity, current_occupancy, is_available) POI rows
+    """
+    crowding: Dict[int, float] = {}
+    elevators = set()
+    for location_id, poi_type, capacity, occupancy, available in rows:
+        if poi_type == "elevator":
+            if available is not False:
+                elevators.add(location_id)
+        elif capacity and occupancy:
+            ratio = min(1.0, occupancy / capacity)
+            excess = max(0.0, (ratio - CROWD_THRESHOLD) / (1 - CROWD_THRESHOLD))
+            if excess > 0:
+                multiplier = 1 + CROWD_PENALTY * excess
+                crowding[location_id] = max(crowding.get(location_id, 1.0), multiplier)
+    return crowding, elevators
+
+
+class RoutingCosts:
+    """
+    Precomputed edge costs for the routing options, layered on the walking
+    distances of graph_cache.
+
+    Each combination of options gets its own per-edge cost array, built once
+    from the current floors, POI occupancy and elevators. Graph changes and
+    POI writes drop them; occupancy flushes only re-cost the edges at the
+    locations whose crowding or elevator availability changed. The searches
+    read the arrays exactly like the plain distances, so the penalties cost
+    nothing per edge at query time.
+    """
+
+    def __init__(self, graph_cache):
+        self._graph_cache = graph_cache
+        self._lock = threading.Lock()
+        # (avoid_crowds, step_free) -> (graph version, generation, EdgeCosts)
+        self._costs = {}
+        # (graph version, generation, floors, crowding, elevators, edge kinds)
+        self._inputs = None
+        # Bumped by invalidate() and refresh_pois() so a build racing with
+        # either is not stored
+        self._generation = 0
+        graph_cache.add_listener(self.invalidate)
+
+    def invalidate(self, change=None):
+        with self._lock:
+            self._costs.clear()
+            self._inputs = None
+            self._generation += 1
+
+    def costs(self, db, graph, avoid_crowds: bool = False, step_free: bool = False) -> Optional[EdgeCosts]:
+        """
+        Edge costs over graph, the one the caller will search, for the
+        options, or None when plain distances apply
+        """
+        if not avoid_crowds and not step_free:
+            return None
+        key = (avoid_crowds, step_free)
+        version = self._graph_cache.version
+        generation = self._generation
+        entry = self._costs.get(key)
+        # The positions must be graph's; a reload in between builds a new id array
+        if (entry is not None and entry[0] == version and entry[1] == generation
+                and entry[2].csr.ids is graph.csr.ids):
+            return entry[2]
+
+        floors, crowding, elevators, kinds = self._load_inputs(db, version, generation)
+        costs = build_edge_costs(graph.csr, floors, crowding, elevators, avoid_crowds, step_free, kinds)
+        with self._lock:
+            if self._graph_cache.version == version and self._generation == generation:
+                self._costs[key] = (version, generation, costs)
+        return costs
+
+    def refresh_pois(self, db, poi_ids: Optional[List[int]]):
+        """
+        Occupancy buffer listener. Re-reads the POIs at the locations of
+        poi_ids, or of every POI if it is None, and patches the cached costs
+        of the edges there: crowd-aware costs where crowding changed,
+        step-free costs where an elevator's availability changed.
+        """
+        inputs = self._inputs
+        if inputs is None or inputs[0] != self._graph_cache.version:
+            # Nothing current to patch; the next query loads fresh inputs
+            return
+
+        from sqlalchemy import select
+        import models
+
+        statement = select(models.POI.location_id)
+        if poi_ids is not None:
+            statement = statement.where(models.POI.id.in_(poi_ids))
+        locations = set(db.execute(statement).scalars())
+        if not locations:
+            return
+        crowding, elevators = poi_inputs(db.execute(select(
+            models.POI.location_id, models.POI.type, models.POI.capacity,
+            models.POI.current_occupancy, models.POI.is_available,
+        ).where(models.POI.location_id.in_(locations))))
+
+        with self._lock:
+            if self._inputs is not inputs:
+                return
+            version, generation, floors, old_crowding, old_elevators, kinds = inputs
+            crowded = {loc_id for loc_id in locations if crowding.get(loc_id) != old_crowding.get(loc_id)}
+            lifts = {loc_id for loc_id in locations if (loc_id in elevators) != (loc_id in old_elevators)}
+            if not crowded and not lifts:
+                return
+
+            new_crowding = {loc_id: m for loc_id, m in old_crowding.items() if loc_id not in locations}
+            new_crowding.update(crowding)
+            new_elevators = (old_elevators - locations) | elevators
+            self._generation += 1
+            self._inputs = (version, self._generation, floors, new_crowding, new_elevators, kinds)
+            for (avoid_crowds, step_free), (entry_version, _, costs) in list(self._costs.items()):
+                changed = (crowded if avoid_crowds else set()) | (lifts if step_free else set())
+                if changed:
+                    cost = edge_cost_function(floors, new_crowding, new_elevators, avoid_crowds, step_free, kinds)
+                    positions = [p for p in map(costs.csr.index_of, changed) if p >= 0]
+                    costs = costs.patched(positions, cost)
+                self._costs[(avoid_crowds, step_free)] = (entry_version, self._generation, costs)
+
+    def _load_inputs(self, db, version: int, generation: int):
+        inputs = self._inputs
+        if inputs is not None and inputs[0] == version and inputs[1] == generation:
+            return inputs[2:]
+
+        # Imported here so the cost model can be built without a database
+        from sqlalchemy import select
+        import models
+
+        floors = dict(db.execute(
+            select(models.Location.id, models.Location.floor).where(models.Location.floor.isnot(None))
+        ).all())
+        crowding, elevators = poi_inputs(db.execute(select(
+            models.POI.location_id, models.POI.type, models.POI.capacity,
+            models.POI.current_occupancy, models.POI.is_available,
+        )))
+
+        # Only stairways, elevators and the like; plain walkways are the default
+        edges = models.path_edges.c
+        kinds = {
+            (from_id, to_id): kind
+            for from_id, to_id, kind in db.execute(
+                select(edges.from_id, edges.to_id, edges.kind).where(edges.kind != "walk")
+            )
+        }
+
+        with self._lock:
+            if self._graph_cache.version == version and self._generation == generation:
+                self._inputs = (version, generation, floors, crowding, elevators, kinds)
+        return floors, crowding, elevators, kinds
+
+
+routing_costs = RoutingCosts(graph_cache)
@@ -1,7 +1,7 @@
 
 # schemas.py
-from typing import List, Optional
-from pydantic import BaseModel, Field
+from typing import Dict, List, Literal, Optional
+from pydantic import BaseModel, Field, root_validator, validator
 from geojson_pydantic import Point
 
 # Authentication schemas
@@ -28,6 +28,10 @@ class User(UserBase):
     class Config:
         orm_mode = True
 
+class UserUpdate(BaseModel):
+    role: Optional[str] = None
+    is_active: Optional[bool] = None
+
 # Location schemas
 class LocationBase(BaseModel):
     name: str
@@ -37,14 +41,21 @@ class LocationBase(BaseModel):
     room_number: Optional[str] = None
     category: str
 
+# How an edge to a location on another floor is walked
+VerticalKind = Literal["stairs", "elevator", "ramp", "escalator"]
+
 class LocationCreate(LocationBase):
     coordinates: Point
     connected_to: Optional[List[int]] = []
+    # Kind of the edge to each connected location on another floor; stairs if missing
+    transitions: Dict[int, VerticalKind] = {}
 
 class LocationUpdate(LocationBase):
     name: Optional[str] = None
     coordinates: Optional[Point] = None
-    connected_to: Optional[List[int]] = []
+    # None keeps the current edges; [] removes them all
+    connected_to: Optional[List[int]] = None
+    transitions: Optional[Dict[int, VerticalKind]] = None
 
 class Location(LocationBase):
     id: int
@@ -52,7 +63,25 @@ class Location(LocationBase):
     
     class Config:
         orm_mode = True
+
+class LocationImport(LocationBase):
+    # Identifier of the row within the import file, referenced by connected_to.
+    # A ref that is not in the file is read as the id of an existing location.
+    ref: str
+    lon: float = Field(..., ge=-180, le=180)
+    lat: float = Field(..., ge=-90, le=90)
+    connected_to: List[str] = []
+
+class ImportResult(BaseModel):
+    locations: int
+    edges: int
         
+class NearestLocation(BaseModel):
+    location_id: int
+    name: str
+    coordinates: Point
+    distance: float  # in meters
+
 # POI schemas
 class POIBase(BaseModel):
     name: str
@@ -72,6 +101,25 @@ class POI(POIBase):
     class Config:
         orm_mode = True
 
+class OccupancyUpdate(BaseModel):
+    # A sensor reading: either an absolute count or a change relative to the
+    # stored one, optionally with availability
+    poi_id: int
+    current_occupancy: Optional[int] = Field(None, ge=0)
+    delta: Optional[int] = None
+    is_available: Optional[bool] = None
+
+    @root_validator(skip_on_failure=True)
+    def check_fields(cls, values):
+        if values.get("current_occupancy") is not None and values.get("delta") is not None:
+            raise ValueError("send either current_occupancy or delta, not both")
+        if all(values.get(key) is None for key in ("current_occupancy", "delta", "is_available")):
+            raise ValueError("nothing to update")
+        return values
+
+class OccupancyAccepted(BaseModel):
+    accepted: int
+
 # Emergency service schemas
 class EmergencyServiceBase(BaseModel):
     type: str
@@ -96,4 +144,36 @@ class PathSegment(BaseModel):
 class Path(BaseModel):
     segments: List[PathSegment]
     total_distance: float
-    estimated_time: float  # in minutes
\ No newline at end of file
+    estimated_time: float  # in minutes
+
+# Each distinct source costs one shortest-path search over the graph
+MATRIX_MAX_SOURCES = 50
+MATRIX_MAX_TARGETS = 200
+
+def _check_count(values: List[int], limit: int) -> List[int]:
+    if not 1 <= len(values) <= limit:
+        raise ValueError(f"must hold between 1 and {limit} location ids")
+    return values
+
+class DistanceMatrixRequest(BaseModel):
+    sources: List[int]
+    targets: List[int]
+
+    # Plain validators rather than conlist, whose keywords differ between pydantic 1 and 2
+    @validator("sources")
+    def check_sources(cls, value):
+        return _check_count(value, MATRIX_MAX_SOURCES)
+
+    @validator("targets")
+    def check_targets(cls, value):
+        return _check_count(value, MATRIX_MAX_TARGETS)
+
+class DistanceMatrix(BaseModel):
+    sources: List[int]
+    targets: List[int]
+    distances: List[List[Optional[float]]]  # [source][target], None if unreachable
+    estimated_times: List[List[Optional[float]]]  # in minutes
+
+class EmergencyRoute(BaseModel):
+    service: EmergencyService
+    path: Path
@@ -0,0 +1,187 @@
+# search.py
+import bisect
+import heapq
+import re
+import threading
+from collections import defaultdict
+from functools import lru_cache
+from typing import Dict, List, Optional, Tuple
+
+# Trigram matches below this similarity are treated as noise
+MIN_SIMILARITY = 0.3
+# How many trigram candidates get fully scored per query
+MAX_CANDIDATES = 200
+# Trigrams shared by more locations than this are too common to be worth counting
+MAX_POSTINGS = 1000
+
+_WORD_RE = re.compile(r"\w+")
+
+
+def _normalize(text: Optional[str]) -> str:
+    return " ".join(_WORD_RE.findall((text or "").lower()))
+
+
+def _trigrams(text: str) -> set:
+    # Words are padded so that short queries and word starts still produce trigrams
+    grams = set()
+    for word in text.split():
+        padded = f"  {word} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return grams
+
+
+@lru_cache(maxsize=65536)
+def _word_trigrams(word: str) -> frozenset:
+    return frozenset(_trigrams(word))
+
+
+class LocationSearchIndex:
+    """
+    In-process search index over Location.name, building and room_number.
+
+    Combines a sorted word list for prefix lookups with a trigram inverted
+    index for typo tolerance. It is loaded from the database on first use and
+    kept current by the location writes in crud.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loaded = False
+        # location_id -> location dict as returned by /locations/
+        self.documents: Dict[int, dict] = {}
+        # location_id -> normalized searchable fields
+        self._fields: Dict[int, Tuple[str, ...]] = {}
+        self._trigrams: Dict[str, set] = defaultdict(set)
+        # Sorted (word, location_id) pairs for prefix search
+        self._words: List[Tuple[str, int]] = []
+
+    def ensure_loaded(self, db, load_documents):
+        if self._loaded:
+            return
+        with self._lock:
+            if self._loaded:
+                return
+            for document in load_documents(db):
+                self._add(document)
+            self._loaded = True
+
+    def _add(self, document: dict):
+        location_id = document['id']
+        fields = tuple(_normalize(document.get(key)) for key in ('name', 'building', 'room_number'))
+        self.documents[location_id] = document
+        self._fields[location_id] = fields
+        for field in fields:
+            for gram in _trigrams(field):
+                self._trigrams[gram].add(location_id)
+            for word in set(field.split()):
+                bisect.insort(self._words, (word, location_id))
+
+    def _remove(self, location_id: int):
+        fields = self._fields.pop(location_id, None)
+        self.documents.pop(location_id, None)
+        if fields is None:
+            return
+        for field in fields:
+            for gram in _trigrams(field):
+                ids = self._trigrams.get(gram)
+                if ids is not None:
+                    ids.discard(location_id)
+                    if not ids:
+                        del self._trigrams[gram]
+            for word in set(field.split()):
+                index = bisect.bisect_left(self._words, (word, location_id))
+                if index < len(self._words) and self._words[index] == (word, location_id):
+                    del self._words[index]
+
+    def invalidate(self):
+        # Drop everything; the next search reloads from the database
+        with self._lock:
+            self._loaded = False
+            self.documents.clear()
+            self._fields.clear()
+            self._trigrams.clear()
+            self._words.clear()
+
+    def upsert(self, document: dict):
+        # Before the first load there is nothing to patch; loading picks it up
+        with self._lock:
+            if self._loaded:
+                self._remove(document['id'])
+                self._add(document)
+
+    def remove(self, location_id: int):
+        with self._lock:
+            if self._loaded:
+                self._remove(location_id)
+
+    def search(self, query: str, limit: int = 10) -> List[dict]:
+        """
+        Location dicts ranked by how well one of their fields matches query
+        """
+        query = _normalize(query)
+        if not query:
+            return []
+
+        with self._lock:
+            candidates = set()
+            # Every word of the query must prefix some word of the document
+            # for a prefix hit; the last word can still be half-typed
+            for word in query.split():
+                ids = set()
+                index = bisect.bisect_left(self._words, (word,))
+                stop = min(len(self._words), index + MAX_CANDIDATES)
+                while index < stop and self._words[index][0].startswith(word):
+                    ids.add(self._words[index][1])
+                    index += 1
+                candidates = ids if not candidates else candidates & ids
+                if not candidates:
+                    break
+            prefix_hits = set(candidates)
+
+            query_grams = _trigrams(query)
+            query_words = [_word_trigrams(word) for word in query.split()]
+            # Enough prefix hits make the fuzzy pass pointless: it cannot outrank them
+            if len(prefix_hits) < limit:
+                postings = sorted((self._trigrams.get(gram, ()) for gram in query_grams), key=len)
+                # Very common trigrams say little about the match but dominate
+                # the cost, so they are skipped unless nothing rarer is left
+                selective = [ids for ids in postings if len(ids) <= MAX_POSTINGS] or postings[:1]
+                counts = defaultdict(int)
+                for ids in selective:
+                    for location_id in ids:
+                        counts[location_id] += 1
+                candidates.update(heapq.nlargest(MAX_CANDIDATES, counts, key=counts.get))
+
+            scored = []
+            for location_id in candidates:
+                score = max(_score(query, query_words, field) for field in self._fields[location_id])
+                if location_id in prefix_hits:
+                    # Query words may be spread over several fields
+                    score = max(score, 1.0)
+                if score >= MIN_SIMILARITY:
+                    scored.append((-score, self.documents[location_id]['name'], location_id))
+            scored.sort()
+            return [self.documents[location_id] for _, _, location_id in scored[:limit]]
+
+
+def _score(query: str, query_words: List[frozenset], field: str) -> float:
+    if not field:
+        return 0.0
+    if field == query:
+        return 3.0
+    if field.startswith(query):
+        return 2.5
+    if f" {query}" in f" {field}":
+        return 2.0
+    if query in field:
+        return 1.5
+    # Each query word is scored against its best-matching field word, so a
+    # typo in one word of a long name isn't diluted by the words around it
+    field_words = [_word_trigrams(word) for word in field.split()]
+    total = 0.0
+    for grams in query_words:
+        total += max(len(grams & other) / len(grams | other) for other in field_words)
+    return total / len(query_words)
+
+
+search_index = LocationSearchIndex()
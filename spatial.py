@@ -0,0 +1,129 @@
+# spatial.py
+import heapq
+import math
+import threading
+from typing import List, Optional, Tuple
+
+from graph import EARTH_RADIUS_M, graph_cache
+
+
+def _to_unit_vector(lon: float, lat: float) -> Tuple[float, float, float]:
+    # Chord length between unit vectors grows monotonically with great-circle
+    # distance, so a plain 3-d KD-tree ranks neighbours correctly on the sphere
+    phi = math.radians(lat)
+    lam = math.radians(lon)
+    return math.cos(phi) * math.cos(lam), math.cos(phi) * math.sin(lam), math.sin(phi)
+
+
+def _chord_to_meters(chord: float) -> float:
+    return 2 * EARTH_RADIUS_M * math.asin(min(1.0, chord / 2))
+
+
+class KDTree:
+    """
+    Static 3-d KD-tree over points on the unit sphere
+    """
+
+    def __init__(self, points: List[Tuple[int, float, float]]):
+        # points: list of (location_id, longitude, latitude)
+        self._ids = [point[0] for point in points]
+        self._vectors = [_to_unit_vector(point[1], point[2]) for point in points]
+        # Node layout: (point index, split axis, left subtree, right subtree)
+        self._root = self._build(list(range(len(points))))
+
+    def __len__(self):
+        return len(self._ids)
+
+    def _build(self, indices):
+        if not indices:
+            return None
+        vectors = self._vectors
+        # Split on the axis with the widest spread; a campus only covers a
+        # tiny patch of the sphere, so cycling through axes wastes levels
+        axis = max(range(3), key=lambda a: (
+            max(vectors[index][a] for index in indices) - min(vectors[index][a] for index in indices)
+        ))
+        indices.sort(key=lambda index: vectors[index][axis])
+        middle = len(indices) // 2
+        return (
+            indices[middle],
+            axis,
+            self._build(indices[:middle]),
+            self._build(indices[middle + 1:]),
+        )
+
+    def nearest(self, lon: float, lat: float, k: int = 1) -> List[Tuple[int, float]]:
+        """
+        Returns up to k (location_id, distance in meters) pairs, nearest first
+        """
+        if k <= 0 or self._root is None:
+            return []
+        target = _to_unit_vector(lon, lat)
+        vectors = self._vectors
+        # Max-heap of (-squared chord, point index) holding the best k so far
+        best = []
+
+        # Entries are (subtree, lower bound of its squared chord to target)
+        stack = [(self._root, 0.0)]
+        while stack:
+            node, bound = stack.pop()
+            if node is None or (len(best) == k and bound >= -best[0][0]):
+                continue
+            index, axis, left, right = node
+            vector = vectors[index]
+            squared = (
+                (vector[0] - target[0]) ** 2
+                + (vector[1] - target[1]) ** 2
+                + (vector[2] - target[2]) ** 2
+            )
+            if len(best) < k:
+                heapq.heappush(best, (-squared, index))
+            elif squared < -best[0][0]:
+                heapq.heapreplace(best, (-squared, index))
+
+            offset = target[axis] - vector[axis]
+            near, far = (left, right) if offset < 0 else (right, left)
+            # The near side is pushed last so it is searched first
+            stack.append((far, max(bound, offset * offset)))
+            stack.append((near, bound))
+
+        return [
+            (self._ids[index], _chord_to_meters(math.sqrt(-negative)))
+            for negative, index in sorted(best, reverse=True)
+        ]
+
+
+class LocationIndex:
+    """
+    KD-tree over the cached graph's location coordinates, rebuilt lazily
+    after graph changes that add, move or remove a location
+    """
+
+    def __init__(self, graph_cache):
+        self._graph_cache = graph_cache
+        self._lock = threading.Lock()
+        self._tree: Optional[KDTree] = None
+        self._version = None
+        graph_cache.add_listener(self._graph_changed)
+
+    def _graph_changed(self, change):
+        # Edge and name edits leave every point where it was
+        if change.kind == "update" and not change.moved:
+            with self._lock:
+                if self._tree is not None and self._version == change.version - 1:
+                    self._version = change.version
+
+    def nearest(self, db, lon: float, lat: float, k: int = 1) -> List[Tuple[int, float]]:
+        version = self._graph_cache.version
+        tree = self._tree
+        if tree is None or self._version != version:
+            graph = self._graph_cache.get(db)
+            points = [(loc_id, lon_lat[0], lon_lat[1]) for loc_id, lon_lat in list(graph.coordinates.items())]
+            tree = KDTree(points)
+            with self._lock:
+                self._tree = tree
+                self._version = version
+        return tree.nearest(lon, lat, k)
+
+
+location_index = LocationIndex(graph_cache)
@@ -1,9 +1,9 @@
 // File: src/components/SearchBar.js
 import React, { useState, useRef, useEffect } from "react";
+import api from "../services/api";
 import "./SearchBar.css";
 
 const SearchBar = ({
-  locations,
   onLocationSelect,
   placeholder = "Search locations...",
 }) => {
@@ -12,23 +12,32 @@ const SearchBar = ({
   const [filteredLocations, setFilteredLocations] = useState([]);
   const dropdownRef = useRef(null);
 
-  // Filter locations based on search term
+  // Search locations on the server, waiting for a pause in typing
   useEffect(() => {
     if (searchTerm.trim() === "") {
       setFilteredLocations([]);
       return;
     }
 
-    const filtered = locations.filter(
-      (location) =>
-        location.name.toLowerCase().includes(searchTerm.toLowerCase()) ||
-        (location.building &&
-          location.building.toLowerCase().includes(searchTerm.toLowerCase())) ||
-        (location.room_number && location.room_number.includes(searchTerm))
-    );
+    let cancelled = false;
+    const timer = setTimeout(async () => {
+      try {
+        const response = await api.get("/locations/search", {
+          params: { q: searchTerm },
+        });
+        if (!cancelled) {
+          setFilteredLocations(response.data);
+        }
+      } catch (err) {
+        console.error("Error searching locations:", err);
+      }
+    }, 150);
 
-    setFilteredLocations(filtered);
-  }, [searchTerm, locations]);
+    return () => {
+      cancelled = true;
+      clearTimeout(timer);
+    };
+  }, [searchTerm]);
 
   // Close dropdown when clicking outside
   useEffect(() => {
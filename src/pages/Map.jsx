@@ -389,6 +389,35 @@ function Map() {
     fetchData();
   }, []);
 
+  // Live occupancy/availability updates instead of re-fetching /poi/
+  useEffect(() => {
+    const source = new EventSource(`${api.defaults.baseURL}/poi/stream`);
+
+    source.addEventListener("poi", (event) => {
+      const { changes } = JSON.parse(event.data);
+      // Plain object: this component's name shadows the global Map
+      const byId = {};
+      changes.forEach((change) => {
+        byId[change.id] = change;
+      });
+      setPois((current) =>
+        current.map((poi) => (byId[poi.id] ? { ...poi, ...byId[poi.id] } : poi))
+      );
+    });
+
+    // The stream fell behind; reload the full list once
+    source.addEventListener("resync", async () => {
+      try {
+        const response = await api.get("/poi/");
+        setPois(response.data);
+      } catch (err) {
+        console.error("Error re-fetching POIs:", err);
+      }
+    });
+
+    return () => source.close();
+  }, []);
+
   // Listen for emergency mode changes from POI sidebar
   const handleEmergencyModeChange = (isActive) => {
     setEmergencyMode(isActive);
@@ -0,0 +1,67 @@
+# user_cache.py
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from metrics import metrics
+
+# How long a resolved user is trusted before it is read from the database again
+USER_CACHE_TTL_SECONDS = 60
+USER_CACHE_MAX_ENTRIES = 10000
+
+
+class PrincipalCache:
+    """
+    TTL + LRU cache of authenticated users keyed by JWT subject (username).
+
+    Entries are plain schemas.User values rather than ORM objects, so they
+    outlive the request session. crud.update_user evicts a user whenever
+    their role or active flag changes.
+    """
+
+    def __init__(self, ttl: float = USER_CACHE_TTL_SECONDS, max_entries: int = USER_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        metrics.gauge("user_cache_size", lambda: len(self._entries))
+        metrics.gauge("user_cache_hits", lambda: self._hits)
+        metrics.gauge("user_cache_misses", lambda: self._misses)
+        metrics.gauge("user_cache_hit_rate", self.hit_rate)
+
+    def get(self, username: str):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(username)
+                self._hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[username]
+            self._misses += 1
+            return None
+
+    def put(self, username: str, principal):
+        with self._lock:
+            self._entries[username] = (time.monotonic() + self.ttl, principal)
+            self._entries.move_to_end(username)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, username: Optional[str] = None):
+        with self._lock:
+            if username is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(username, None)
+
+    def hit_rate(self) -> float:
+        total = self._hits + self._misses
+        return self._hits / total if total else 0.0
+
+
+user_cache = PrincipalCache()
@@ -0,0 +1,38 @@
+# wkb.py
+import struct
+from typing import Tuple
+
+_BIG_ENDIAN_HEADER = struct.Struct(">I")
+_LITTLE_ENDIAN_HEADER = struct.Struct("<I")
+_BIG_ENDIAN_XY = struct.Struct(">dd")
+_LITTLE_ENDIAN_XY = struct.Struct("<dd")
+
+_WKB_POINT = 1
+# EWKB flag for an embedded SRID (PostGIS style)
+_EWKB_SRID_FLAG = 0x20000000
+_LITTLE_ENDIAN_POINT_HEADER = b"\x01\x01\x00\x00\x00"
+
+
+def point_from_wkb(data) -> Tuple[float, float]:
+    """
+    Decodes a WKB/EWKB POINT (as returned by ST_AsBinary) into (x, y)
+    without going through GeoJSON or shapely
+    """
+    data = bytes(data)
+    # Fast path: little-endian 2-d point, which is what MySQL returns
+    if data[:5] == _LITTLE_ENDIAN_POINT_HEADER and len(data) == 21:
+        return _LITTLE_ENDIAN_XY.unpack_from(data, 5)
+    little_endian = data[0] == 1
+    header = _LITTLE_ENDIAN_HEADER if little_endian else _BIG_ENDIAN_HEADER
+    geometry_type = header.unpack_from(data, 1)[0]
+    offset = 5
+    if geometry_type & _EWKB_SRID_FLAG:
+        offset += 4
+    if geometry_type & 0xFF != _WKB_POINT:
+        raise ValueError(f"Expected a WKB POINT, got geometry type {geometry_type}")
+    return (_LITTLE_ENDIAN_XY if little_endian else _BIG_ENDIAN_XY).unpack_from(data, offset)
+
+
+def point_to_geojson(data) -> dict:
+    x, y = point_from_wkb(data)
+    return {'type': 'Point', 'coordinates': [x, y]}